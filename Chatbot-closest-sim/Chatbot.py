@@ -1,26 +1,48 @@
 import os
 import re
 import sys
+import json
+import math
+import mmap
 import time
-import pickle
+import heapq
+import fcntl
+import hashlib
 import logging
+import tempfile
+import sqlite3
+import random
+import queue
+import threading
+import uuid
+import multiprocessing
+from urllib.parse import urlparse
+from contextlib import closing, contextmanager
+from collections import OrderedDict, deque, namedtuple
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import numpy as np
+import faiss
 import openai
+import requests
 import tiktoken
-from flask import Flask, request, render_template, jsonify
+from flask import Flask, Response, request, render_template, jsonify, stream_with_context
 from flask_cors import CORS
 from flask_restx import Api, Resource, fields
 from flask_redis import FlaskRedis 
 from redis.exceptions import ConnectionError
-from sklearn.metrics.pairwise import cosine_similarity
-from sklearn.feature_extraction.text import TfidfVectorizer
+from langchain.callbacks import get_openai_callback
 from langchain.chains.question_answering import load_qa_chain
 from langchain.chains.qa_with_sources import load_qa_with_sources_chain
-from langchain.document_loaders import PyPDFLoader, WebBaseLoader
-from langchain.embeddings import OpenAIEmbeddings
+from langchain.docstore.base import AddableMixin, Docstore
+from langchain.docstore.document import Document
+from langchain.document_loaders import PyPDFLoader
+from langchain.embeddings.base import Embeddings
 from langchain.llms import OpenAI
 from langchain.text_splitter import CharacterTextSplitter
 from langchain.vectorstores import FAISS
 from colorama import init, Fore, Style
+from bs4 import BeautifulSoup
 
 init(autoreset=True)
 
@@ -65,10 +87,145 @@ if not OPENAI_MODEL_NAME:
     raise ValueError("OPENAI_MODEL_NAME environment variable not set")
 
 OPENAI_TEMPERATURE = 0
+CHAT_COMPLETION_ERROR = "OpenAI API Error: ChatCompletion"
+RAG_TIMEOUT = float(os.getenv('RAG_TIMEOUT', 30))
+COMPLETION_TIMEOUT = float(os.getenv('COMPLETION_TIMEOUT', 30))
+CONVERSATION_TOKEN_BUDGET = int(os.getenv('CONVERSATION_TOKEN_BUDGET', 2000))
+CONVERSATION_SUMMARY = os.getenv('CONVERSATION_SUMMARY', 'true').lower() == 'true'
+CONVERSATION_SUMMARY_TOKENS = int(os.getenv('CONVERSATION_SUMMARY_TOKENS', 256))
+CONVERSATION_BACKEND = os.getenv('CONVERSATION_BACKEND', 'memory')
+# USD per 1K tokens
+PROMPT_TOKEN_PRICE = float(os.getenv('PROMPT_TOKEN_PRICE', 0.002))
+COMPLETION_TOKEN_PRICE = float(os.getenv('COMPLETION_TOKEN_PRICE', 0.002))
+CHAT_EXECUTOR_WORKERS = int(os.getenv('CHAT_EXECUTOR_WORKERS', 16))
+WEB_FETCH_WORKERS = int(os.getenv('WEB_FETCH_WORKERS', 16))
+WEB_FETCH_PER_HOST = int(os.getenv('WEB_FETCH_PER_HOST', 4))
+WEB_FETCH_TIMEOUT = float(os.getenv('WEB_FETCH_TIMEOUT', 10))
+WEB_FETCH_RETRIES = int(os.getenv('WEB_FETCH_RETRIES', 2))
+WEB_FETCH_BACKOFF = float(os.getenv('WEB_FETCH_BACKOFF', 0.5))
+PDF_WORKERS = int(os.getenv('PDF_WORKERS', os.cpu_count() or 1))
+INGEST_BATCH_SIZE = int(os.getenv('INGEST_BATCH_SIZE', 256))
+INGEST_MAX_IN_FLIGHT = int(os.getenv('INGEST_MAX_IN_FLIGHT', 2 * (os.cpu_count() or 1)))
+QUERY_CACHE_SIZE = int(os.getenv('QUERY_CACHE_SIZE', 1024))
+QUERY_CACHE_TTL = int(os.getenv('QUERY_CACHE_TTL', 3600))
+ANSWER_CACHE_SIZE = int(os.getenv('ANSWER_CACHE_SIZE', 1024))
+ANSWER_CACHE_TTL = int(os.getenv('ANSWER_CACHE_TTL', 7 * 24 * 3600))
+ANSWER_CACHE_PERSIST = os.getenv('ANSWER_CACHE_PERSIST', 'true').lower() == 'true'
+QA_CHAIN_TYPE = "stuff"
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', 2000))
+SEARCH_K = int(os.getenv('SEARCH_K', 4))
+HYBRID_SEARCH = os.getenv('HYBRID_SEARCH', 'true').lower() == 'true'
+RRF_K = int(os.getenv('RRF_K', 60))
+LEXICAL_FAST_PATH = os.getenv('LEXICAL_FAST_PATH', 'false').lower() == 'true'
+LEXICAL_FAST_PATH_SCORE = float(os.getenv('LEXICAL_FAST_PATH_SCORE', 0.8))
+LEXICAL_FAST_PATH_RATIO = float(os.getenv('LEXICAL_FAST_PATH_RATIO', 2.0))
+ANSWER_SIMILARITY_THRESHOLD = float(os.getenv('ANSWER_SIMILARITY_THRESHOLD', 0.2))
+SEMANTIC_CACHE_ENABLED = os.getenv('SEMANTIC_CACHE_ENABLED', 'false').lower() == 'true'
+SEMANTIC_CACHE_SIZE = int(os.getenv('SEMANTIC_CACHE_SIZE', 512))
+# ada-002 embeddings of unrelated questions are often above 0.9 cosine similarity
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv('SEMANTIC_CACHE_THRESHOLD', 0.98))
+EMBEDDING_MODEL_NAME = os.getenv('EMBEDDING_MODEL_NAME', 'text-embedding-ada-002')
+OPENAI_API_BASE = os.getenv('OPENAI_API_BASE', 'https://api.openai.com/v1')
+EMBEDDING_BATCH_SIZE = int(os.getenv('EMBEDDING_BATCH_SIZE', 256))
+EMBEDDING_BATCH_TOKENS = int(os.getenv('EMBEDDING_BATCH_TOKENS', 50000))
+EMBEDDING_CONCURRENCY = int(os.getenv('EMBEDDING_CONCURRENCY', 4))
+INDEX_NAME = 'faiss_index'
+MANIFEST_FILE = 'manifest.json'
+# flat (exact), ivf or hnsw
+INDEX_TYPE = os.getenv('INDEX_TYPE', 'flat').lower()
+IVF_NLIST = int(os.getenv('IVF_NLIST', 0))
+IVF_NPROBE = int(os.getenv('IVF_NPROBE', 16))
+HNSW_M = int(os.getenv('HNSW_M', 32))
+HNSW_EF_CONSTRUCTION = int(os.getenv('HNSW_EF_CONSTRUCTION', 200))
+HNSW_EF_SEARCH = int(os.getenv('HNSW_EF_SEARCH', 128))
+# none, fp16 or sq8, optionally after a PCA projection to VECTOR_PCA_DIM dimensions
+VECTOR_COMPRESSION = os.getenv('VECTOR_COMPRESSION', 'none').lower()
+VECTOR_PCA_DIM = int(os.getenv('VECTOR_PCA_DIM', 0))
+COMPACT_VECTORS = VECTOR_COMPRESSION != 'none' or VECTOR_PCA_DIM > 0
+RESCORE_FACTOR = int(os.getenv('RESCORE_FACTOR', 4))
+INGESTION_JOB_TTL = int(os.getenv('INGESTION_JOB_TTL', 7 * 24 * 3600))
+# Seconds between two scans of DOCUMENT_STORE_DIRECTORY for added, changed or removed PDF files, 0 to scan only at startup
+DOCUMENT_WATCH_INTERVAL = float(os.getenv('DOCUMENT_WATCH_INTERVAL', 60))
+# Rebuild the index from the chunk store once the chunks of changed or removed PDF files reach this fraction of it
+COMPACT_REMOVED_RATIO = float(os.getenv('COMPACT_REMOVED_RATIO', 0.25))
 #openai.api_key =  os.getenv('OPENAI_API_KEY')
 
 # functions
-messages = []
+index_lock = threading.Lock()
+pending_urls = set()
+pending_urls_lock = threading.Lock()
+host_semaphores = {}
+host_semaphores_lock = threading.Lock()
+token_encoding = tiktoken.get_encoding("cl100k_base")
+context_stats = {"requests": 0, "retrieved_tokens": 0, "packed_tokens": 0, "saved_tokens": 0}
+context_stats_lock = threading.Lock()
+retrieval_stats = {"dense": 0, "hybrid": 0, "lexical_fast_path": 0}
+retrieval_stats_lock = threading.Lock()
+
+def create_http_session():
+    """
+    Create the keep-alive HTTP session shared by all web page fetches
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=WEB_FETCH_WORKERS, pool_maxsize=WEB_FETCH_WORKERS)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers.update({"User-Agent": "Mozilla/5.0 (compatible; Ophelia/0.1)"})
+    return session
+
+def host_semaphore(url):
+    """
+    Semaphore limiting the number of concurrent requests to the host of the URL
+    """
+    host = urlparse(url).netloc
+    with host_semaphores_lock:
+        if host not in host_semaphores:
+            host_semaphores[host] = threading.BoundedSemaphore(WEB_FETCH_PER_HOST)
+        return host_semaphores[host]
+
+def fetch_webpage(url):
+    """
+    Fetch a web page over the shared session and return it as a Document.
+    Timeouts, connection errors, 429 and 5xx responses are retried with exponential backoff.
+    """
+    for attempt in range(WEB_FETCH_RETRIES + 1):
+        try:
+            with host_semaphore(url):
+                response = http_session.get(url, timeout=WEB_FETCH_TIMEOUT)
+            if response.status_code != 429 and response.status_code < 500:
+                response.raise_for_status()
+                break
+            error = f"HTTP {response.status_code}"
+        except requests.HTTPError:
+            raise
+        except requests.RequestException as e:
+            error = e
+        if attempt == WEB_FETCH_RETRIES:
+            raise IOError(f"Could not fetch {url} after {attempt + 1} attempts: {error}")
+        time.sleep(WEB_FETCH_BACKOFF * 2 ** attempt * (1 + random.random()))
+
+    # requests decodes text/html without a charset header as ISO-8859-1, the bytes let the <meta charset> decide
+    charset = response.encoding if 'charset' in response.headers.get('Content-Type', '').lower() else None
+    soup = BeautifulSoup(response.content, 'html.parser', from_encoding=charset)
+    title = soup.title.get_text().strip() if soup.title else ""
+    return Document(page_content=soup.get_text(), metadata={"source": url, "title": title})
+
+def fetch_webpages(urls):
+    """
+    Fetch several web pages concurrently. Pages that cannot be fetched are logged and skipped,
+    the others are returned in the order of the URLs.
+    """
+    def fetch_or_log(url):
+        try:
+            return fetch_webpage(url)
+        except Exception as e:
+            error_msg = f"Could not read {url}, skipping it: {e}"
+            logger.error(Fore.RED + error_msg)
+            return None
+
+    with ThreadPoolExecutor(max_workers=WEB_FETCH_WORKERS) as executor:
+        pages = list(executor.map(fetch_or_log, urls))
+    return [page for page in pages if page is not None]
 
 def read_from_web(webpage=None):
     """
@@ -76,51 +233,153 @@ def read_from_web(webpage=None):
     """
     if webpage is None:
         return []
-    web_loader = WebBaseLoader(webpage)     
-    raw_text = []
-    raw_text.extend(web_loader.load())
-    return raw_text
+    return [fetch_webpage(webpage)]
 
-def read_from_webpages_url():
+def get_webpages_urls():
     """
-    Read content from web pages listed in the WEBPAGES_URLS environment variable
+    Return the list of URLs in the WEBPAGES_URLS environment variable
     """
     webpages_urls = os.getenv("WEBPAGES_URLS")
-    if webpages_urls:
-        urls = webpages_urls.split(",")
-        raw_text = []
-        for url in urls:
-            url = url.strip()
-            raw_text.extend(read_from_web(url))
-        return raw_text
+    if not webpages_urls:
+        return []
+    return [url.strip() for url in webpages_urls.split(",") if url.strip()]
+
+def read_from_webpages_url():
+    """
+    Read content from web pages listed in the WEBPAGES_URLS environment variable, fetching them concurrently
+    """
+    urls = get_webpages_urls()
+    if urls:
+        return fetch_webpages(urls)
     else:
         warning_msg = "WEBPAGES_URLS environment variable not set or empty."
         logger.warning(Fore.YELLOW + warning_msg)
         return []
 
-def read_from_PDF():
+def get_pdf_files():
     """
-    Read all PDF files in the document store directory and concatenate the text
+    Return the sorted list of PDF files in the document store directory
+    """
+    return sorted(filename for filename in os.listdir(DOCUMENT_STORE_DIRECTORY) if filename.lower().endswith('.pdf'))
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def scan_pdf_files(previous=None):
+    """
+    Size, modification time and content hash of each PDF file in the document store directory. The hash is only
+    computed again for the files whose size or modification time changed since the previous scan, and the chunk
+    positions of a file are only carried over while its content is the same. A file without them has to be indexed.
+    """
+    previous = previous or {}
+    pdfs = {}
+    for filename in get_pdf_files():
+        path = os.path.join(DOCUMENT_STORE_DIRECTORY, filename)
+        stat = os.stat(path)
+        entry = previous.get(filename, {})
+        if entry.get("size") == stat.st_size and entry.get("mtime") == stat.st_mtime and "sha256" in entry:
+            pdfs[filename] = entry
+            continue
+        pdfs[filename] = {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": file_sha256(path)}
+        if entry.get("sha256") == pdfs[filename]["sha256"] and "chunks" in entry:
+            pdfs[filename]["chunks"] = entry["chunks"]
+    return pdfs
+
+def load_pdf(filepath):
+    """
+    Load the pages of a single PDF file. Runs in a worker process, so errors are returned instead of raised
+    to keep one broken file from aborting the whole load.
+    """
+    try:
+        return PyPDFLoader(filepath).load(), None
+    except Exception as e:
+        return [], f"{type(e).__name__}: {e}"
+
+def iter_pdf_pages(pdf_files=None, workers=None):
+    """
+    Yield the pages of the PDF files in the document store directory, or of the given ones, in file order so the
+    chunks of a file are contiguous.
+    Files are parsed in parallel by the given number of processes (PDF_WORKERS by default) with at most
+    INGEST_MAX_IN_FLIGHT files parsed ahead of the consumer, so memory does not grow with the number of files.
     """
     if not DOCUMENT_STORE_DIRECTORY:
         raise ValueError("DOCUMENT_STORE_DIRECTOR environment variable not set")
     if not os.path.isdir(DOCUMENT_STORE_DIRECTORY):
         raise ValueError(f"{DOCUMENT_STORE_DIRECTORY} is not a directory")
 
-    raw_text = []
     # Gather files
-    pdf_files = [filename for filename in os.listdir(DOCUMENT_STORE_DIRECTORY) if filename.lower().endswith('.pdf')]
-
-    if pdf_files:
-        for filename in pdf_files:
-            filepath = os.path.join(DOCUMENT_STORE_DIRECTORY, filename)
-            pdf_loader = PyPDFLoader(filepath)
-            raw_text.extend(pdf_loader.load())
-    else:
+    pdf_files = get_pdf_files() if pdf_files is None else pdf_files
+    if not pdf_files:
         warning_msg = "No PDF files found in the document store directory."
         logger.warning(Fore.YELLOW + warning_msg)
+        return
+
+    workers = min(workers or PDF_WORKERS, len(pdf_files))
+
+    def results():
+        if workers <= 1:
+            for filename in pdf_files:
+                yield filename, load_pdf(os.path.join(DOCUMENT_STORE_DIRECTORY, filename))
+            return
+        # Fork explicitly, a spawned or forkserver worker would re-import this module and rebuild the index
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork')) as executor:
+            pending = deque()
+            for filename in pdf_files:
+                pending.append((filename, executor.submit(load_pdf, os.path.join(DOCUMENT_STORE_DIRECTORY, filename))))
+                if len(pending) >= INGEST_MAX_IN_FLIGHT:
+                    filename, future = pending.popleft()
+                    yield filename, future.result()
+            while pending:
+                filename, future = pending.popleft()
+                yield filename, future.result()
+
+    pages_count = 0
+    for filename, (pages, error) in results():
+        if error:
+            error_msg = f"Could not read {filename}, skipping it: {error}"
+            logger.error(Fore.RED + error_msg)
+        pages_count += len(pages)
+        yield from pages
+    logger.info(f"Read {pages_count} pages from {len(pdf_files)} PDF files with {workers} workers")
 
-    return raw_text
+def read_from_PDF():
+    """
+    Read all PDF files in the document store directory and concatenate the text
+    """
+    return list(iter_pdf_pages())
+
+def iter_documents(submitted_urls):
+    """
+    Yield every source document of the index: the WEBPAGES_URLS pages, the submitted pages and the PDF pages
+    """
+    yield from read_from_webpages_url()
+    if submitted_urls:
+        yield from fetch_webpages(submitted_urls)
+    yield from iter_pdf_pages()
+
+def iter_chunks(documents):
+    """
+    Split the documents lazily, one document at a time
+    """
+    for document in documents:
+        yield from split_text([document])
+
+def batched(iterable, size):
+    """
+    Group the items of an iterable in lists of at most size items
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 def split_text(raw_text):
     """
@@ -135,121 +394,1906 @@ def split_text(raw_text):
     texts = text_splitter.split_documents(raw_text)
     return texts
 
-def create_embeddings(texts):
+class EmbeddingExecutor:
     """
-    Create OpenAI embeddings for the text chunks
+    Client for the OpenAI embeddings endpoint that groups chunks into token-budgeted batches and runs a bounded number
+    of batches concurrently. Batch size and concurrency are halved on 429 responses, batch size shrinks when latency
+    goes above the target and both grow back while requests succeed. Failed batches are retried with jittered backoff.
+    """
+    def __init__(self, api_base, api_key, model_name, max_batch_size=256, max_batch_tokens=50000, max_concurrency=4,
+                 target_latency=10.0, max_retries=5, backoff=1.0, timeout=60, token_counter=None):
+        self.url = api_base.rstrip('/') + '/embeddings'
+        self.headers = {"Authorization": f"Bearer {api_key}"}
+        self.model_name = model_name
+        self.max_batch_size = max_batch_size
+        self.max_batch_tokens = max_batch_tokens
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        if token_counter is None:
+            encoding = tiktoken.get_encoding("cl100k_base")
+            token_counter = lambda text: len(encoding.encode(text))
+        self.token_counter = token_counter
+        self.session = requests.Session()
+        self.condition = threading.Condition()
+        self.batch_size = max_batch_size
+        self.concurrency = max_concurrency
+        self.in_flight = 0
+        self.successes = 0
+        self.stats = {"chunks": 0, "batches": 0, "rate_limited": 0, "retries": 0, "chunks_per_second": 0.0}
+
+    def after_fork(self):
+        # Keep-alive connections and the condition of the parent must not be shared with a forked worker
+        self.session = requests.Session()
+        self.condition = threading.Condition()
+        self.in_flight = 0
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= self.concurrency:
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def on_rate_limit(self):
+        with self.condition:
+            self.batch_size = max(1, self.batch_size // 2)
+            self.concurrency = max(1, self.concurrency // 2)
+            self.successes = 0
+            self.stats["rate_limited"] += 1
+
+    def on_success(self, latency, size):
+        with self.condition:
+            self.stats["batches"] += 1
+            self.stats["chunks"] += size
+            if latency > self.target_latency:
+                self.batch_size = max(1, int(self.batch_size * 0.75))
+                return
+            self.batch_size = min(self.max_batch_size, self.batch_size + max(1, self.max_batch_size // 8))
+            self.successes += 1
+            if self.successes % 4 == 0 and self.concurrency < self.max_concurrency:
+                self.concurrency += 1
+                self.condition.notify_all()
+
+    def run_batch(self, texts, start, end, results, slot=True):
+        """
+        Embed texts[start:end] into results[start:end], retrying rate limits, server errors and network errors.
+        A batch holds the concurrency slot acquired by embed() while its request is in flight, and gives it up while
+        it backs off. Without a slot the request is sent right away.
+        """
+        holding = slot
+        try:
+            for attempt in range(self.max_retries + 1):
+                if slot and not holding:
+                    self.acquire()
+                    holding = True
+                started = time.time()
+                retry_after = None
+                try:
+                    response = self.session.post(self.url, headers=self.headers, timeout=self.timeout,
+                                                 json={"model": self.model_name, "input": texts[start:end]})
+                    if response.status_code == 429:
+                        self.on_rate_limit()
+                        retry_after = response.headers.get('Retry-After')
+                    if response.status_code != 429 and response.status_code < 500:
+                        response.raise_for_status()
+                        data = sorted(response.json()["data"], key=lambda item: item["index"])
+                        results[start:end] = [item["embedding"] for item in data]
+                        self.on_success(time.time() - started, end - start)
+                        return
+                    error = f"HTTP {response.status_code}"
+                except requests.HTTPError:
+                    raise
+                except requests.RequestException as e:
+                    error = e
+                if attempt == self.max_retries:
+                    raise IOError(f"Embedding request failed after {attempt + 1} attempts: {error}")
+                with self.condition:
+                    self.stats["retries"] += 1
+                if holding:
+                    self.release()
+                    holding = False
+                delay = float(retry_after) if retry_after else self.backoff * 2 ** attempt
+                time.sleep(delay * (0.5 + random.random()))
+        finally:
+            if holding:
+                self.release()
+
+    def embed(self, texts):
+        texts = list(texts)
+        tokens = [self.token_counter(text) for text in texts]
+        results = [None] * len(texts)
+        futures = []
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as pool:
+            position = 0
+            while position < len(texts):
+                # Wait for a free slot before cutting the next batch, so it uses the latest batch size
+                self.acquire()
+                end = position + 1
+                budget = tokens[position]
+                while end < len(texts) and end - position < self.batch_size and budget + tokens[end] <= self.max_batch_tokens:
+                    budget += tokens[end]
+                    end += 1
+                futures.append(pool.submit(self.run_batch, texts, position, end, results))
+                position = end
+        for future in futures:
+            future.result()
+        return results
+
+    def embed_documents(self, texts):
+        started = time.time()
+        results = self.embed(texts)
+        elapsed = max(time.time() - started, 1e-6)
+        self.stats["chunks_per_second"] = round(len(results) / elapsed, 1)
+        logger.info(f"Embedded {len(results)} chunks in {elapsed:.1f}s ({self.stats['chunks_per_second']} chunks/s, "
+                    f"batch size {self.batch_size}, concurrency {self.concurrency}, {self.stats['rate_limited']} rate limited)")
+        return results
+
+    def embed_query(self, text):
+        # Queries are on the request path: sent from the calling thread without waiting for a slot behind the
+        # ingestion batches
+        results = [None]
+        self.run_batch([text], 0, 1, results, slot=False)
+        return results[0]
+
+class CachedEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that keeps every chunk vector on disk, keyed by a hash of the embedding model and the chunk text.
+    Vectors are appended to a float32 matrix that is memory-mapped for reads, so rebuilding the index only calls the
+    embedding API for chunks that were never embedded before. Each model has its own matrix in a subdirectory, as
+    models do not have the same dimension.
+    """
+    def __init__(self, embeddings, model_name, cache_directory):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.directory = os.path.join(cache_directory, re.sub(r'[^\w.-]', '_', model_name))
+        os.makedirs(self.directory, exist_ok=True)
+        self.vectors_path = os.path.join(self.directory, 'vectors.f32')
+        self.keys_path = os.path.join(self.directory, 'keys.tsv')
+        self.meta_path = os.path.join(self.directory, 'meta.json')
+        self.lock_path = os.path.join(self.directory, 'cache.lock')
+        self.lock = threading.Lock()
+        self.rows = {}
+        self.keys_offset = 0
+        self.dimension = None
+        self.vectors = None
+        self.hits = 0
+        self.misses = 0
+        self.adopt_legacy_cache(cache_directory)
+
+    def adopt_legacy_cache(self, cache_directory):
+        """
+        Move a cache written before the per-model subdirectories into this one when it holds vectors of this model
+        """
+        legacy_meta_path = os.path.join(cache_directory, 'meta.json')
+        if os.path.exists(self.meta_path) or not os.path.exists(legacy_meta_path):
+            return
+        with open(legacy_meta_path) as f:
+            if json.load(f).get("model") != self.model_name:
+                return
+        # meta.json last, a move interrupted halfway is completed on the next start
+        for path in (self.vectors_path, self.keys_path, self.meta_path):
+            legacy_path = os.path.join(cache_directory, os.path.basename(path))
+            if os.path.exists(legacy_path):
+                os.replace(legacy_path, path)
+        logger.info(f"Moved the embedding cache of {self.model_name} to {self.directory}")
+
+    def chunk_key(self, text):
+        return hashlib.sha256((self.model_name + "\0" + text).encode('utf-8')).hexdigest()
+
+    @contextmanager
+    def locked(self):
+        # The thread lock protects this process, the file lock the other workers sharing the cache
+        with self.lock, open(self.lock_path, 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def refresh(self):
+        """
+        Pick up the rows appended to the cache since the last read, including the ones written by other processes
+        """
+        if self.dimension is None and os.path.exists(self.meta_path):
+            with open(self.meta_path) as f:
+                self.dimension = json.load(f)["dimension"]
+        if not os.path.exists(self.keys_path):
+            return
+        with open(self.keys_path, 'rb') as f:
+            f.seek(self.keys_offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                key, row = line.decode('ascii').split('\t')
+                self.rows[key] = int(row)
+                self.keys_offset += len(line)
+        rows_count = max(self.rows.values()) + 1 if self.rows else 0
+        if rows_count and (self.vectors is None or self.vectors.shape[0] < rows_count):
+            self.vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(rows_count, self.dimension))
+
+    def append(self, keys, vectors):
+        """
+        Append new vectors to the matrix first and their keys second, so a key never points to a missing row
+        """
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.dimension is None:
+            self.dimension = vectors.shape[1]
+            with open(self.meta_path, 'w') as f:
+                json.dump({"model": self.model_name, "dimension": self.dimension}, f)
+        elif vectors.shape[1] != self.dimension:
+            raise ValueError(f"The embedding cache of {self.model_name} holds {self.dimension} dimension vectors, got {vectors.shape[1]}")
+        with open(self.vectors_path, 'ab') as f:
+            first_row = f.tell() // (self.dimension * 4)
+            f.write(vectors.tobytes())
+        with open(self.keys_path, 'ab') as f:
+            f.write(''.join(f"{key}\t{first_row + i}\n" for i, key in enumerate(keys)).encode('ascii'))
+
+    def embed_documents(self, texts):
+        keys = [self.chunk_key(text) for text in texts]
+        with self.locked():
+            self.refresh()
+            missing = {key: text for key, text in zip(keys, texts) if key not in self.rows}
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            # Call the API outside the lock, a chunk embedded twice by two workers only costs a duplicate row
+            new_vectors = self.embeddings.embed_documents(list(missing.values()))
+            with self.locked():
+                self.append(list(missing.keys()), new_vectors)
+                self.refresh()
+        logger.info(f"Embedding cache: {len(texts) - len(missing)} hits, {len(missing)} misses")
+        if not keys:
+            return []
+        return [self.vectors[self.rows[key]].tolist() for key in keys]
+
+    def embed_query(self, text):
+        return self.embeddings.embed_query(text)
+
+def create_embeddings():
+    """
+    Create the OpenAI embeddings client for the text chunks, backed by the on-disk embedding cache
+    """
+    executor = EmbeddingExecutor(
+        OPENAI_API_BASE,
+        os.getenv('OPENAI_API_KEY'),
+        EMBEDDING_MODEL_NAME,
+        max_batch_size=EMBEDDING_BATCH_SIZE,
+        max_batch_tokens=EMBEDDING_BATCH_TOKENS,
+        max_concurrency=EMBEDDING_CONCURRENCY,
+        token_counter=count_tokens,
+    )
+    cache_directory = os.path.join(INDEX_STORE_DIRECTORY, 'embedding_cache')
+    return CachedEmbeddings(executor, EMBEDDING_MODEL_NAME, cache_directory)
+
+def build_ann_index(vectors, index_type, compression='none', pca_dim=0):
+    """
+    Build a FAISS index of the given type over the vectors: exact flat, IVF with a coarse quantizer trained on the
+    vectors (IVF_NLIST lists, about 4 * sqrt(n) by default) or HNSW (HNSW_M links per node). Vectors are stored as
+    float16 or 8 bit scalar quantized codes with the fp16 and sq8 compressions, after a PCA projection to pca_dim
+    dimensions when it is set. IVF falls back to flat when there are fewer than 39 training vectors per list.
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    dimension = vectors.shape[1]
+    storage = {"fp16": "SQfp16", "sq8": "SQ8"}.get(compression, "Flat")
+    nlist = 0
+    if index_type == 'ivf':
+        # FAISS wants at least 39 training vectors per list
+        nlist = IVF_NLIST or min(int(4 * math.sqrt(len(vectors))), len(vectors) // 39)
+        if nlist == 0 or len(vectors) < 39 * nlist:
+            warning_msg = f"Not enough vectors to train {nlist} IVF lists, using a flat index"
+            logger.warning(Fore.YELLOW + warning_msg)
+            return build_ann_index(vectors, 'flat', compression, pca_dim)
+        description = f"IVF{nlist},{storage}"
+    elif index_type == 'hnsw':
+        description = f"HNSW{HNSW_M}" if storage == "Flat" else f"HNSW{HNSW_M}_{storage}"
+    else:
+        description = storage
+    if 0 < pca_dim < min(dimension, len(vectors)):
+        description = f"PCA{pca_dim}," + description
+    index = faiss.index_factory(dimension, description)
+    if isinstance(base_index(index), faiss.IndexHNSW):
+        base_index(index).hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    if not index.is_trained:
+        sample = np.random.default_rng(0).choice(len(vectors), min(len(vectors), max(256 * nlist, 65536)), replace=False)
+        index.train(vectors[sample])
+    index.add(vectors)
+    configure_search(index)
+    return index
+
+def base_index(index):
+    """
+    The index under the PCA projection of a compact index
+    """
+    if isinstance(index, faiss.IndexPreTransform):
+        return faiss.downcast_index(index.index)
+    return index
+
+def configure_search(index):
+    """
+    Apply the search time parameters, which are not part of the index build
+    """
+    index = base_index(index)
+    if isinstance(index, faiss.IndexIVF):
+        index.nprobe = IVF_NPROBE
+    elif isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = HNSW_EF_SEARCH
+
+def index_settings():
+    """
+    Build parameters of the configured index type, part of the manifest so that changing them rebuilds the index
+    """
+    settings = {"type": INDEX_TYPE}
+    if INDEX_TYPE == 'ivf':
+        settings["nlist"] = IVF_NLIST
+    elif INDEX_TYPE == 'hnsw':
+        settings.update(m=HNSW_M, ef_construction=HNSW_EF_CONSTRUCTION)
+    if COMPACT_VECTORS:
+        settings.update(compression=VECTOR_COMPRESSION, pca_dim=VECTOR_PCA_DIM)
+    return settings
+
+def full_vectors_path():
+    return os.path.join(INDEX_STORE_DIRECTORY, INDEX_NAME + '.vectors')
+
+def write_full_vectors(vectors):
+    """
+    Write the full precision vectors that the candidates of a compact index are re-scored against
+    """
+    tmp_path = full_vectors_path() + '.tmp'
+    np.ascontiguousarray(vectors, dtype=np.float32).tofile(tmp_path)
+    os.replace(tmp_path, full_vectors_path())
+
+def append_full_vectors(vectors):
+    with open(full_vectors_path(), 'ab') as f:
+        np.ascontiguousarray(vectors, dtype=np.float32).tofile(f)
+
+def load_full_vectors(docsearch):
+    """
+    Memory-map the full precision vectors of a compact index. Returns None when the index is not compact, or when the
+    file does not match the index, the candidates are then not re-scored.
+    """
+    if docsearch is None or not COMPACT_VECTORS or docsearch.index.ntotal == 0:
+        return None
+    shape = (docsearch.index.ntotal, docsearch.index.d)
+    path = full_vectors_path()
+    if not os.path.exists(path) or os.path.getsize(path) != shape[0] * shape[1] * 4:
+        warning_msg = f"{path} does not match the index, search results will not be re-scored"
+        logger.warning(Fore.YELLOW + warning_msg)
+        return None
+    return np.memmap(path, dtype=np.float32, mode='r', shape=shape)
+
+def rescore(vectors, query_vector, ids, k):
+    """
+    Re-rank the candidate ids by their exact L2 distance to the query
+    """
+    ids = [int(i) for i in ids if i != -1]
+    if not ids:
+        return []
+    distances = ((np.asarray(vectors[ids]) - query_vector) ** 2).sum(axis=1)
+    return [ids[i] for i in np.argsort(distances)[:k]]
+
+def index_bytes_per_vector(index):
+    """
+    Serialized size of the index per vector, without the fixed size of the trained empty index
+    """
+    empty = faiss.clone_index(index)
+    empty.reset()
+    return (faiss.serialize_index(index).nbytes - faiss.serialize_index(empty).nbytes) / max(index.ntotal, 1)
+
+def compact_report(index, vectors, k=10, queries=50):
+    """
+    Memory per 1M chunks of a compact index and its recall@k against exact search, with and without re-scoring
+    the candidates against the full precision vectors
+    """
+    k = min(k, len(vectors))
+    query_vectors = vectors[np.random.default_rng(1).choice(len(vectors), min(queries, len(vectors)), replace=False)]
+    exact_ids = faiss.knn(query_vectors, vectors, k)[1]
+    found_ids = index.search(query_vectors, k)[1]
+    candidate_ids = index.search(query_vectors, k * RESCORE_FACTOR)[1]
+    rescored_ids = [rescore(vectors, query_vector, ids, k) for query_vector, ids in zip(query_vectors, candidate_ids)]
+    recall = lambda results: float(np.mean([len(set(found) & set(exact)) / k for found, exact in zip(results, exact_ids)]))
+    return {
+        "memory_per_1m_chunks_mb": round(index_bytes_per_vector(index) * 1e6 / 2 ** 20, 1),
+        "full_precision_per_1m_chunks_mb": round(vectors.shape[1] * 4 * 1e6 / 2 ** 20, 1),
+        f"recall@{k}": round(recall(found_ids), 4),
+        f"recall@{k}_rescored": round(recall(rescored_ids), 4),
+    }
+
+class ChunkStore(Docstore, AddableMixin):
+    """
+    Docstore keeping the chunk text and metadata in a single append-only file with an offset index, both memory-mapped
+    read-only. Documents are only built for the chunks looked up, and the workers on a host share the mapped pages
+    through the page cache. The id of a chunk is its position, which is also its position in the FAISS index.
+    """
+    def __init__(self, directory, count=None):
+        self.directory = directory
+        self.lock = threading.Lock()
+        for extension in ('.chunks', '.offsets'):
+            open(self.path(extension), 'ab').close()
+        if count is not None:
+            self.truncate(count)
+        self.remap()
+
+    def path(self, extension):
+        return os.path.join(self.directory, INDEX_NAME + extension)
+
+    def count_on_disk(self):
+        return os.path.getsize(self.path('.offsets')) // 8
+
+    def replaced(self):
+        """
+        Check if the files were replaced by a rebuilt index since they were mapped
+        """
+        return os.stat(self.path('.offsets')).st_ino != self.inode
+
+    def truncate(self, count):
+        """
+        Drop the chunks appended after the last saved index
+        """
+        if self.count_on_disk() < count:
+            raise ValueError(f"The chunk store has {self.count_on_disk()} chunks, the index has {count}")
+        offsets = np.fromfile(self.path('.offsets'), dtype=np.uint64, count=count)
+        with open(self.path('.offsets'), 'r+b') as f:
+            f.truncate(count * 8)
+        with open(self.path('.chunks'), 'r+b') as f:
+            f.truncate(int(offsets[-1]) if count else 0)
+
+    def remap(self, count=None):
+        """
+        Map the chunks on disk, the first count ones or all of them
+        """
+        count = self.count_on_disk() if count is None else count
+        self.inode = os.stat(self.path('.offsets')).st_ino
+        offsets = np.memmap(self.path('.offsets'), dtype=np.uint64, mode='r', shape=(count,)) if count else np.zeros(0, dtype=np.uint64)
+        data = b''
+        if count:
+            with open(self.path('.chunks'), 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # Readers take both attributes at once, the previous maps stay valid until they are released
+        self.mapping = (data, offsets)
+
+    def __len__(self):
+        return len(self.mapping[1])
+
+    def document(self, position):
+        data, offsets = self.mapping
+        start = int(offsets[position - 1]) if position else 0
+        record = json.loads(data[start:int(offsets[position])])
+        return Document(page_content=record["text"], metadata=record["metadata"])
+
+    def documents(self, start=0):
+        for position in range(start, len(self)):
+            yield self.document(position)
+
+    def search(self, search):
+        """
+        Docstore interface: the chunk of the given id, or a not found message as the InMemoryDocstore returns
+        """
+        if str(search).isdigit() and int(search) < len(self):
+            return self.document(int(search))
+        return f"ID {search} not found."
+
+    def add(self, texts):
+        """
+        AddableMixin interface: the documents are appended in order, their ids are their positions
+        """
+        self.append(texts.values())
+
+    def append(self, docs):
+        with self.lock:
+            end = os.path.getsize(self.path('.chunks'))
+            ends = []
+            with open(self.path('.chunks'), 'ab') as f:
+                for doc in docs:
+                    record = json.dumps({"text": doc.page_content, "metadata": doc.metadata}, default=str).encode('utf-8')
+                    f.write(record)
+                    end += len(record)
+                    ends.append(end)
+            with open(self.path('.offsets'), 'ab') as f:
+                np.array(ends, dtype=np.uint64).tofile(f)
+            self.remap()
+
+    def move(self, directory):
+        """
+        Move the files to another directory on the same file system, the mapped pages stay valid
+        """
+        for extension in ('.chunks', '.offsets'):
+            os.replace(self.path(extension), os.path.join(directory, INDEX_NAME + extension))
+        self.directory = directory
+
+    def discard(self):
+        """
+        Remove a store that was being built and its directory
+        """
+        for extension in ('.chunks', '.offsets'):
+            os.remove(self.path(extension))
+        os.rmdir(self.directory)
+
+class ChunkIds(Mapping):
+    """
+    FAISS position to docstore id mapping of a ChunkStore: the id of a chunk is its position, so nothing is stored
+    """
+    def __init__(self, store):
+        self.store = store
+
+    def __getitem__(self, position):
+        if not 0 <= position < len(self.store):
+            raise KeyError(position)
+        return str(position)
+
+    def __iter__(self):
+        return iter(range(len(self.store)))
+
+    def __len__(self):
+        return len(self.store)
+
+    def update(self, ids):
+        # The ids were assigned when the documents were added to the ChunkStore
+        pass
+
+def create_index(texts, embeddings):
+    """
+    Create a FAISS index for the text chunks. The chunks can be a generator: they are embedded and added to the index
+    in batches of INGEST_BATCH_SIZE, so only one batch is held in memory besides the index itself. The chunks go to
+    a new ChunkStore in a build directory, save_index() moves it in place.
+    The chunks are indexed exactly first, then moved to an INDEX_TYPE index once all the vectors are known.
+    With COMPACT_VECTORS the full precision vectors are written to disk for re-scoring.
+    """
+    store = ChunkStore(tempfile.mkdtemp(dir=INDEX_STORE_DIRECTORY))
+    try:
+        docsearch = None
+        for batch in batched(texts, INGEST_BATCH_SIZE):
+            vectors = np.array(embeddings.embed_documents([text.page_content for text in batch]), dtype=np.float32)
+            if docsearch is None:
+                docsearch = FAISS(embeddings.embed_query, faiss.IndexFlatL2(vectors.shape[1]), store, ChunkIds(store))
+            docsearch.index.add(vectors)
+            store.append(batch)
+        if docsearch is None:
+            warning_msg = "No texts found. Skipping index creation."
+            logger.warning(Fore.YELLOW + warning_msg)
+            store.discard()
+        elif INDEX_TYPE != 'flat' or COMPACT_VECTORS:
+            vectors = docsearch.index.reconstruct_n(0, docsearch.index.ntotal)
+            docsearch.index = build_ann_index(vectors, INDEX_TYPE, VECTOR_COMPRESSION, VECTOR_PCA_DIM)
+            if COMPACT_VECTORS:
+                write_full_vectors(vectors)
+                logger.info(f"Compact {INDEX_TYPE} index ({VECTOR_COMPRESSION}, PCA {VECTOR_PCA_DIM or 'off'}): {compact_report(docsearch.index, vectors)}")
+        return docsearch
+    except Exception as e:
+        error_msg = f"An error occurred during index creation: {e}"
+        logger.error(Fore.RED + error_msg)
+        store.discard()
+        return None
+
+def add_chunks(docsearch, docs, embeddings):
+    """
+    Embed the chunks and append them to the FAISS index and to the chunk store, in the same order so positions match
+    """
+    vectors = np.array(embeddings.embed_documents([doc.page_content for doc in docs]), dtype=np.float32)
+    docsearch.index.add(vectors)
+    docsearch.docstore.append(docs)
+    return vectors
+
+class BM25Index:
+    """
+    In-process inverted index scoring the chunks with BM25, built from the same chunks as the FAISS index.
+    Exact terms such as part numbers, error codes and names are matched without an embedding call.
+    With a document function resolving a position to its Document, the chunk text is not kept in memory.
+    """
+    def __init__(self, k1=1.5, b=0.75, document=None):
+        self.k1 = k1
+        self.b = b
+        self.document = document
+        self.count = 0
+        self.docs = []
+        self.lengths = []
+        self.total_length = 0
+        self.postings = {}
+        self.removed = set()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def tokenize(text):
+        tokens = []
+        for token in re.findall(r"\w+(?:[-./:]\w+)*", text.lower()):
+            tokens.append(token)
+            # Also index the parts of compound tokens such as "e-1042" or "v2.1"
+            parts = re.findall(r"\w+", token)
+            if len(parts) > 1:
+                tokens.extend(parts)
+        return tokens
+
+    def add(self, docs):
+        with self.lock:
+            for doc in docs:
+                tokens = self.tokenize(doc.page_content)
+                counts = {}
+                for token in tokens:
+                    counts[token] = counts.get(token, 0) + 1
+                position = self.count
+                self.count += 1
+                if self.document is None:
+                    self.docs.append(doc)
+                self.lengths.append(len(tokens))
+                self.total_length += len(tokens)
+                for token, count in counts.items():
+                    self.postings.setdefault(token, []).append((position, count))
+
+    def search(self, query, k):
+        """
+        Return the k best (document, score) pairs, best first
+        """
+        with self.lock:
+            documents = self.count - len(self.removed)
+            if not documents:
+                return []
+            average_length = self.total_length / documents
+            scores = {}
+            for token in set(self.tokenize(query)):
+                postings = self.postings.get(token)
+                if not postings:
+                    continue
+                idf = math.log(1 + (documents - len(postings) + 0.5) / (len(postings) + 0.5))
+                for position, count in postings:
+                    norm = count + self.k1 * (1 - self.b + self.b * self.lengths[position] / average_length)
+                    scores[position] = scores.get(position, 0.0) + idf * count * (self.k1 + 1) / norm
+            best = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+        if self.document is not None:
+            return [(self.document(position), score) for position, score in best]
+        return [(self.docs[position], score) for position, score in best]
+
+    def query_weight(self, query):
+        """
+        Score of an average length chunk containing each term of the query once, dividing a score by it makes scores
+        comparable across queries and corpus sizes
+        """
+        with self.lock:
+            documents = self.count - len(self.removed)
+            weight = 0.0
+            for token in set(self.tokenize(query)):
+                postings = self.postings.get(token)
+                if postings:
+                    weight += math.log(1 + (documents - len(postings) + 0.5) / (len(postings) + 0.5))
+            return weight
+
+    def document_frequencies(self, tokens):
+        """
+        Number of documents and the number of documents containing each token
+        """
+        with self.lock:
+            return self.count - len(self.removed), [len(self.postings.get(token, ())) for token in tokens]
+
+    def copy(self):
+        """
+        Copy to add documents to while the original keeps serving searches
+        """
+        with self.lock:
+            other = BM25Index(self.k1, self.b, self.document)
+            other.count = self.count
+            other.docs = list(self.docs)
+            other.lengths = list(self.lengths)
+            other.total_length = self.total_length
+            other.postings = {token: list(postings) for token, postings in self.postings.items()}
+            other.removed = set(self.removed)
+        return other
+
+    def remove(self, positions):
+        """
+        Drop the documents at the given positions, the positions are not reused
+        """
+        with self.lock:
+            positions = set(positions) - self.removed
+            if not positions:
+                return
+            for token, postings in list(self.postings.items()):
+                postings = [posting for posting in postings if posting[0] not in positions]
+                if postings:
+                    self.postings[token] = postings
+                else:
+                    del self.postings[token]
+            self.total_length -= sum(self.lengths[position] for position in positions)
+            self.removed |= positions
+
+    def reset(self):
+        with self.lock:
+            self.count = 0
+            self.docs = []
+            self.lengths = []
+            self.total_length = 0
+            self.postings = {}
+            self.removed = set()
+
+    def __len__(self):
+        return self.count
+
+class AnswerScorer:
+    """
+    Cosine similarity of answers over TF-IDF vectors. The IDF weights come from the indexed corpus through the BM25
+    index, so nothing is fitted per request and the weights follow the index as it grows.
+    A batch of candidate answers is scored against the reference in one matrix product.
+    """
+    def __init__(self, bm25_index):
+        self.bm25_index = bm25_index
+
+    def idf(self, tokens):
+        documents, frequencies = self.bm25_index.document_frequencies(tokens)
+        return np.log((1 + documents) / (1 + np.array(frequencies, dtype=np.float64))) + 1
+
+    def score(self, reference, candidates):
+        """
+        Cosine similarity of each candidate answer to the reference answer
+        """
+        tokenized = [BM25Index.tokenize(text) for text in [reference] + list(candidates)]
+        vocabulary = {}
+        rows, columns = [], []
+        for row, tokens in enumerate(tokenized):
+            for token in tokens:
+                rows.append(row)
+                columns.append(vocabulary.setdefault(token, len(vocabulary)))
+        vectors = np.zeros((len(tokenized), len(vocabulary)))
+        np.add.at(vectors, (rows, columns), 1)
+        vectors *= self.idf(list(vocabulary))
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors /= np.where(norms == 0, 1, norms)
+        return vectors[1:] @ vectors[0]
+
+def build_bm25_index(docsearch):
+    """
+    Build the BM25 index from the chunk store, search results are read back from it
+    """
+    if docsearch is None:
+        return BM25Index()
+    bm25_index = BM25Index(document=docsearch.docstore.document)
+    bm25_index.add(docsearch.docstore.documents())
+    return bm25_index
+
+@contextmanager
+def index_file_lock():
+    """
+    Hold an exclusive lock on the index directory so that only one process builds or writes the index at a time
     """
     if not INDEX_STORE_DIRECTORY:
         raise ValueError("INDEX_STORE_DIRECTORY environment variable not set check the file .env")
     if not os.path.isdir(INDEX_STORE_DIRECTORY):
         raise ValueError(f"{INDEX_STORE_DIRECTORY} is not a directory")
-    embeddings = OpenAIEmbeddings()
-    index_path = os.path.join(INDEX_STORE_DIRECTORY, 'Index.pkl')
-    with open(index_path, 'wb') as f:
-        pickle.dump(embeddings, f)
-    return embeddings
+    with open(os.path.join(INDEX_STORE_DIRECTORY, 'index.lock'), 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
 
-def create_index(texts, embeddings):
+def build_manifest(submitted_urls, previous_pdfs=None):
+    """
+    Describe the sources the index is built from, so that a stale index on disk can be detected
+    """
+    manifest = {
+        "embedding_model": EMBEDDING_MODEL_NAME,
+        "pdfs": scan_pdf_files(previous_pdfs),
+        "webpages": get_webpages_urls(),
+        "submitted_urls": list(submitted_urls),
+        "chunk_store": True,
+        "pdf_chunks": True,
+        "removed_chunks": [],
+    }
+    # Flat indexes keep the manifest of the indexes built before the index type was configurable
+    if INDEX_TYPE != 'flat' or COMPACT_VECTORS:
+        manifest["index"] = index_settings()
+    return manifest
+
+def same_sources(saved_manifest, manifest, ignored=("pdfs", "removed_chunks")):
+    """
+    Check if an index saved with saved_manifest was built from the same sources, except for the PDF files which
+    sync_pdf_files() brings up to date
+    """
+    return {key: value for key, value in saved_manifest.items() if key not in ignored} == {key: value for key, value in manifest.items() if key not in ignored}
+
+def pdf_chunk_ranges(store, start=0):
+    """
+    Positions [start, end) of the chunks of each PDF file in the chunk store, from the given position on.
+    The chunks of a file are added together, so they are contiguous.
+    """
+    directory = os.path.abspath(DOCUMENT_STORE_DIRECTORY)
+    ranges = {}
+    for position, doc in enumerate(store.documents(start), start):
+        source = doc.metadata.get("source", "")
+        if os.path.dirname(os.path.abspath(source)) == directory:
+            ranges.setdefault(os.path.basename(source), [position, position])[1] = position + 1
+    return ranges
+
+def removed_positions(manifest):
+    """
+    Positions of the chunks of changed or removed PDF files, still in the index until it is compacted
+    """
+    ranges = manifest.get("removed_chunks", [])
+    if not ranges:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate([np.arange(start, end, dtype=np.int64) for start, end in ranges])
+
+def search_parameters(index, removed):
+    """
+    FAISS search parameters excluding the removed positions from the results, None when there are none
     """
-    Create a FAISS index for the text chunks
+    if not len(removed):
+        return None
+    selector = faiss.IDSelectorNot(faiss.IDSelectorBatch(removed))
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        # IVF indexes take their own parameters type, which also carries nprobe
+        return faiss.SearchParametersIVF(sel=selector, nprobe=ivf.nprobe)
+    return faiss.SearchParameters(sel=selector)
+
+def read_manifest():
     """
+    Read the manifest of the index stored on disk, None if there is no usable manifest
+    """
+    manifest_path = os.path.join(INDEX_STORE_DIRECTORY, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
     try:
-        if not texts or not embeddings:
-            warning_msg = "No texts or embeddings found. Skipping index creation."
-            logger.warning(Fore.YELLOW + warning_msg)
+        with open(manifest_path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        warning_msg = f"Could not read the index manifest, the index will be rebuilt: {e}"
+        logger.warning(Fore.YELLOW + warning_msg)
+        return None
+
+def save_index(docsearch, manifest):
+    """
+    Persist the FAISS index and its manifest in the index store directory. The chunks of a new index are moved in from
+    their build directory, later chunks are appended to the store in place.
+    Files are written to a temporary directory first and moved in place, so readers never see a half written index.
+    Returns the index read back memory-mapped from the saved file, in place of the private copy it was written from.
+    """
+    store = docsearch.docstore
+    if os.path.abspath(store.directory) != os.path.abspath(INDEX_STORE_DIRECTORY):
+        build_dir = store.directory
+        store.move(INDEX_STORE_DIRECTORY)
+        os.rmdir(build_dir)
+    tmp_dir = tempfile.mkdtemp(dir=INDEX_STORE_DIRECTORY)
+    try:
+        faiss.write_index(docsearch.index, os.path.join(tmp_dir, INDEX_NAME + '.faiss'))
+        os.replace(os.path.join(tmp_dir, INDEX_NAME + '.faiss'), os.path.join(INDEX_STORE_DIRECTORY, INDEX_NAME + '.faiss'))
+        manifest_tmp_path = os.path.join(tmp_dir, MANIFEST_FILE)
+        with open(manifest_tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(manifest_tmp_path, os.path.join(INDEX_STORE_DIRECTORY, MANIFEST_FILE))
+    finally:
+        for filename in os.listdir(tmp_dir):
+            os.remove(os.path.join(tmp_dir, filename))
+        os.rmdir(tmp_dir)
+    return FAISS(embeddings.embed_query, read_index_file(), store, docsearch.index_to_docstore_id)
+
+def read_index_file():
+    """
+    Read the saved FAISS index memory-mapped, so the workers share its pages through the OS page cache instead of each
+    holding a private copy. A mapped index is read-only, writable_index() copies it to add chunks. The file is only
+    ever replaced, never rewritten, so a mapping stays valid. Versions of faiss without IO_FLAG_MMAP_IFC read a copy.
+    """
+    flags = faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY if hasattr(faiss, 'IO_FLAG_MMAP_IFC') else 0
+    index = faiss.read_index(os.path.join(INDEX_STORE_DIRECTORY, INDEX_NAME + '.faiss'), flags)
+    configure_search(index)
+    return index
+
+def writable_index(index):
+    """
+    Private copy of an index to add chunks to, faiss.clone_index() would keep the mapping of a mapped index
+    """
+    index = faiss.deserialize_index(faiss.serialize_index(index))
+    configure_search(index)
+    return index
+
+def load_index(embeddings):
+    """
+    Load the FAISS index from disk, None if it cannot be read.
+    Chunks appended after the index was last saved are dropped from the chunk store.
+    """
+    try:
+        index = read_index_file()
+        store = ChunkStore(INDEX_STORE_DIRECTORY, count=index.ntotal)
+        return FAISS(embeddings.embed_query, index, store, ChunkIds(store))
+    except Exception as e:
+        warning_msg = f"Could not load the index from disk, the index will be rebuilt: {e}"
+        logger.warning(Fore.YELLOW + warning_msg)
+        return None
+
+def refresh_index(snapshot):
+    """
+    Catch up with the chunks other workers added to the index on disk since this one was loaded, so that chunks are
+    appended after theirs. Returns the FAISS index, the BM25 index and the manifest to add the next chunks to: those
+    of the snapshot when the index on disk did not change, new ones otherwise. Called under the index file lock.
+    """
+    docsearch, bm25_index = snapshot.docsearch, snapshot.bm25_index
+    if docsearch is None:
+        # Another worker may have saved the first index since this one started with an empty corpus
+        saved_manifest = read_manifest()
+        if saved_manifest is None or not same_sources(saved_manifest, manifest, ("pdfs", "removed_chunks", "submitted_urls")):
+            return docsearch, bm25_index, manifest
+        if not os.path.exists(os.path.join(INDEX_STORE_DIRECTORY, INDEX_NAME + '.faiss')):
+            return docsearch, bm25_index, saved_manifest
+        docsearch = load_index(embeddings)
+        if docsearch is None:
+            return docsearch, bm25_index, saved_manifest
+        logger.info(f"Loaded the index saved by another worker from {INDEX_STORE_DIRECTORY}, {docsearch.index.ntotal} chunks")
+        return docsearch, build_bm25_index(docsearch), saved_manifest
+    store = docsearch.docstore
+    replaced = store.replaced()
+    if not replaced and store.count_on_disk() == len(store):
+        # Another worker may still have removed the chunks of PDF files
+        return docsearch, bm25_index, read_manifest() or manifest
+    index = read_index_file()
+    if replaced:
+        # Another worker rebuilt the index, the snapshot keeps its own mapping of the previous files
+        store = ChunkStore(INDEX_STORE_DIRECTORY)
+        bm25_index = BM25Index(document=store.document)
+    else:
+        bm25_index = bm25_index.copy()
+    store.remap(index.ntotal)
+    bm25_index.add(store.documents(len(bm25_index)))
+    logger.info(f"Reloaded the index from {INDEX_STORE_DIRECTORY}, {index.ntotal} chunks")
+    return FAISS(embeddings.embed_query, index, store, ChunkIds(store)), bm25_index, read_manifest() or manifest
+
+def evaluate_index(k=10, queries=200):
+    """
+    Report recall@k and query latency of each index type on the indexed corpus, against exact search, with the
+    configured vector compression. The vectors come from the embedding cache. The queries are sampled from them and
+    held out of the evaluated indexes so that a query does not simply find itself.
+    """
+    docsearch = live_index.docsearch
+    if docsearch is None:
+        raise ValueError("No index to evaluate")
+    texts = [doc.page_content for doc in docsearch.docstore.documents()]
+    vectors = np.array(embeddings.embed_documents(texts), dtype=np.float32)
+    if len(vectors) < 2:
+        raise ValueError("Not enough chunks to hold out queries")
+    order = np.random.default_rng(1).permutation(len(vectors))
+    held_out = max(1, min(queries, len(vectors) // 5))
+    query_vectors, vectors = vectors[order[:held_out]], vectors[order[held_out:]]
+    k = min(k, len(vectors))
+    exact_ids = faiss.knn(query_vectors, vectors, k)[1]
+    report = {"chunks": len(vectors), "queries": len(query_vectors), "k": k, "compression": VECTOR_COMPRESSION, "pca_dim": VECTOR_PCA_DIM}
+    for index_type in ('flat', 'ivf', 'hnsw'):
+        started = time.perf_counter()
+        index = build_ann_index(vectors, index_type, VECTOR_COMPRESSION, VECTOR_PCA_DIM)
+        build_seconds = time.perf_counter() - started
+        ids = []
+        latencies = []
+        for query_vector in query_vectors:
+            started = time.perf_counter()
+            if COMPACT_VECTORS:
+                ids.append(rescore(vectors, query_vector, index.search(query_vector[None, :], k * RESCORE_FACTOR)[1][0], k))
+            else:
+                ids.append(index.search(query_vector[None, :], k)[1][0])
+            latencies.append(time.perf_counter() - started)
+        recall = np.mean([len(set(found) & set(exact)) / k for found, exact in zip(ids, exact_ids)])
+        report[index_type] = {
+            "build_seconds": round(build_seconds, 3),
+            f"recall@{k}": round(float(recall), 4),
+            "latency_ms_mean": round(float(np.mean(latencies)) * 1000, 3),
+            "latency_ms_p95": round(float(np.percentile(latencies, 95)) * 1000, 3),
+            "memory_per_1m_chunks_mb": round(index_bytes_per_vector(index) * 1e6 / 2 ** 20, 1),
+        }
+    return report
+
+def build_or_load_index(embeddings):
+    """
+    Load the index from the index store directory, rebuilding and persisting it only when the sources other than the
+    PDF files changed. The PDF files changed since the index was saved are then synced by sync_pdf_files().
+    Returns the index and the manifest describing it.
+    """
+    with index_file_lock():
+        saved_manifest = read_manifest() or {}
+        submitted_urls = saved_manifest.get("submitted_urls", [])
+        manifest = build_manifest(submitted_urls, saved_manifest.get("pdfs"))
+        if same_sources(saved_manifest, manifest):
+            docsearch = load_index(embeddings)
+            if docsearch is not None:
+                logger.info(f"Loaded index from {INDEX_STORE_DIRECTORY}")
+                return docsearch, saved_manifest
+
+        logger.info("Sources changed or no index found on disk, rebuilding the index")
+        docsearch = create_index(iter_chunks(iter_documents(submitted_urls)), embeddings)
+        if docsearch is not None:
+            ranges = pdf_chunk_ranges(docsearch.docstore)
+            manifest["pdfs"] = {filename: dict(entry, chunks=ranges.get(filename, [0, 0])) for filename, entry in manifest["pdfs"].items()}
+            docsearch = save_index(docsearch, manifest)
+        return docsearch, manifest
+
+class IndexSnapshot(namedtuple('IndexSnapshot', ['docsearch', 'bm25_index', 'full_vectors', 'search_params', 'version'])):
+    """
+    The index served to queries: the FAISS index, the BM25 index, the full precision vectors, the FAISS search
+    parameters excluding the removed chunks and the version scoping the caches. A snapshot is never modified,
+    ingestion publishes a new one, so a query searches one consistent index.
+    """
+    __slots__ = ()
+
+def publish_index(docsearch, bm25_index, new_manifest):
+    """
+    Replace the live index with a snapshot of the given indexes. Queries take live_index once, the assignment is atomic.
+    """
+    global live_index, manifest
+    removed = removed_positions(new_manifest)
+    if not bm25_index.removed.issuperset(removed.tolist()):
+        bm25_index = bm25_index.copy()
+        bm25_index.remove(removed.tolist())
+    search_params = search_parameters(docsearch.index, removed) if docsearch is not None else None
+    manifest = new_manifest
+    live_index = IndexSnapshot(docsearch, bm25_index, load_full_vectors(docsearch), search_params, index_fingerprint(new_manifest))
+
+def queue_webpage(webpage):
+    """
+    Queue the ingestion of a web page and return the job id, or None when the URL is already indexed or queued
+    """
+    webpage = webpage.strip()
+    with pending_urls_lock:
+        if webpage in manifest["webpages"] or webpage in manifest["submitted_urls"] or webpage in pending_urls:
             return None
+        pending_urls.add(webpage)
+    try:
+        return ingestion_queue.submit(webpage)
+    except Exception:
+        with pending_urls_lock:
+            pending_urls.discard(webpage)
+        raise
 
-        docsearch = FAISS.from_documents(texts, embeddings)
-        return docsearch
+def extend_index(docsearch, bm25_index, new_texts):
+    """
+    A private copy of the FAISS and BM25 indexes with the new chunks added, the given ones keep serving queries.
+    The chunk store is append-only and shared by both.
+    """
+    if docsearch is None:
+        docsearch = create_index(new_texts, embeddings)
+        return docsearch, build_bm25_index(docsearch)
+    if not new_texts:
+        return docsearch, bm25_index
+    docsearch = FAISS(embeddings.embed_query, writable_index(docsearch.index), docsearch.docstore, docsearch.index_to_docstore_id)
+    vectors = add_chunks(docsearch, new_texts, embeddings)
+    if COMPACT_VECTORS:
+        append_full_vectors(vectors)
+    bm25_index = bm25_index.copy()
+    bm25_index.add(new_texts)
+    return docsearch, bm25_index
+
+def compact_index(docsearch, manifest):
+    """
+    Rebuild the index from the chunk store without the removed chunks. The vectors come from the embedding cache.
+    """
+    removed = set(removed_positions(manifest).tolist())
+    docs = (doc for position, doc in enumerate(docsearch.docstore.documents()) if position not in removed)
+    docsearch = create_index(docs, embeddings)
+    ranges = pdf_chunk_ranges(docsearch.docstore) if docsearch is not None else {}
+    pdfs = {filename: dict(entry, chunks=ranges.get(filename, [0, 0])) for filename, entry in manifest["pdfs"].items()}
+    logger.info(f"Compacted the index, {len(removed)} chunks removed")
+    return docsearch, dict(manifest, pdfs=pdfs, removed_chunks=[])
+
+def sync_pdf_files(workers=1):
+    """
+    Bring the index up to date with the PDF files added, changed or removed in the document store directory: only the
+    new and changed files are read, split and embedded. The chunks of the changed and removed files are excluded from
+    search until they reach COMPACT_REMOVED_RATIO of the index, which is then compacted.
+    The files are parsed in this process by default: forking a process that runs request threads is not safe.
+    Returns the number of files indexed or removed.
+    """
+    with index_lock, index_file_lock():
+        docsearch, bm25_index, current_manifest = refresh_index(live_index)
+        pdfs = scan_pdf_files(current_manifest["pdfs"])
+        changed = [filename for filename, entry in pdfs.items() if "chunks" not in entry]
+        removed = [entry["chunks"] for filename, entry in current_manifest["pdfs"].items()
+                   if "chunks" in entry and (filename not in pdfs or "chunks" not in pdfs[filename])]
+        if pdfs == current_manifest["pdfs"]:
+            if docsearch is not live_index.docsearch or current_manifest != manifest:
+                publish_index(docsearch, bm25_index, current_manifest)
+            return 0
+        # The files are embedded under the lock, the other workers find their chunks in the embedding cache
+        new_texts = list(iter_chunks(iter_pdf_pages(changed, workers))) if changed else []
+        start = len(docsearch.docstore) if docsearch is not None else 0
+        docsearch, bm25_index = extend_index(docsearch, bm25_index, new_texts)
+        ranges = pdf_chunk_ranges(docsearch.docstore, start) if new_texts and docsearch is not None else {}
+        end = len(docsearch.docstore) if docsearch is not None else 0
+        for filename in changed:
+            pdfs[filename]["chunks"] = ranges.get(filename, [end, end])
+        removed_chunks = current_manifest.get("removed_chunks", []) + [chunks for chunks in removed if chunks[0] < chunks[1]]
+        new_manifest = dict(current_manifest, pdfs=pdfs, removed_chunks=removed_chunks)
+        if docsearch is not None and len(removed_positions(new_manifest)) > COMPACT_REMOVED_RATIO * docsearch.index.ntotal:
+            docsearch, new_manifest = compact_index(docsearch, new_manifest)
+            bm25_index = build_bm25_index(docsearch)
+        if docsearch is not None:
+            docsearch = save_index(docsearch, new_manifest)
+        publish_index(docsearch, bm25_index, new_manifest)
+    logger.info(f"Synced {DOCUMENT_STORE_DIRECTORY}: {len(changed)} PDF files indexed, {len(removed)} removed or replaced")
+    return len(changed) + len(set(current_manifest["pdfs"]) - set(pdfs))
+
+def load_startup_index():
+    """
+    Load or build the index, then sync the PDF files changed while the app was down. A failed sync is logged and
+    the loaded index serves meanwhile, the document watcher retries the sync.
+    """
+    docsearch, new_manifest = build_or_load_index(embeddings)
+    publish_index(docsearch, build_bm25_index(docsearch), new_manifest)
+    try:
+        sync_pdf_files(PDF_WORKERS)
     except Exception as e:
-        error_msg = f"An error occurred during index creation: {e}"
+        error_msg = f"Could not sync the PDF files of {DOCUMENT_STORE_DIRECTORY} at startup: {e}"
         logger.error(Fore.RED + error_msg)
+
+def retry_index_build():
+    """
+    Load or build the index again when it could not be built at startup, for example while the embeddings API was
+    unreachable. Another worker may have built and saved it in the meantime.
+    """
+    with index_lock:
+        docsearch, new_manifest = build_or_load_index(embeddings)
+        publish_index(docsearch, build_bm25_index(docsearch), new_manifest)
+    if docsearch is not None:
+        logger.info("Index built after a failed startup build, the worker is ready")
+
+def watch_document_store():
+    """
+    Sync the PDF files of the document store directory every DOCUMENT_WATCH_INTERVAL seconds, or retry the index
+    build while the worker is not ready
+    """
+    while True:
+        time.sleep(DOCUMENT_WATCH_INTERVAL)
+        try:
+            if index_ready():
+                sync_pdf_files()
+            else:
+                retry_index_build()
+        except Exception as e:
+            error_msg = f"Could not sync the PDF files of {DOCUMENT_STORE_DIRECTORY}: {e}"
+            logger.error(Fore.RED + error_msg)
+
+def start_document_watcher():
+    """
+    Started in the processes serving requests only: by after_fork() in the pre-fork workers, or under __main__
+    """
+    if DOCUMENT_WATCH_INTERVAL > 0:
+        threading.Thread(target=watch_document_store, name='document-watcher', daemon=True).start()
+
+def add_webpage(webpage):
+    """
+    Ingestion job of a web page, run by the ingestion queue: only the new page is split and embedded. Its chunks are
+    added to a copy of the live FAISS and BM25 indexes, which are saved and then published, so queries never see a
+    partly updated index. The chunk store is append-only and shared with the previous snapshot.
+    Returns the number of chunks added.
+    """
+    try:
+        new_texts = split_text(read_from_web(webpage))
+        # Embed outside the lock, adding the documents below is then served by the embedding cache
+        embeddings.embed_documents([text.page_content for text in new_texts])
+        with index_lock, index_file_lock():
+            docsearch, bm25_index, current_manifest = refresh_index(live_index)
+            if webpage in current_manifest["webpages"] or webpage in current_manifest["submitted_urls"]:
+                # Indexed by another worker meanwhile
+                publish_index(docsearch, bm25_index, current_manifest)
+                return 0
+            docsearch, bm25_index = extend_index(docsearch, bm25_index, new_texts)
+            new_manifest = dict(current_manifest, submitted_urls=current_manifest["submitted_urls"] + [webpage])
+            if docsearch is not None:
+                docsearch = save_index(docsearch, new_manifest)
+            publish_index(docsearch, bm25_index, new_manifest)
+        logger.info(f"Added {len(new_texts)} chunks from {webpage} to the index")
+        return len(new_texts)
+    finally:
+        with pending_urls_lock:
+            pending_urls.discard(webpage)
+
+class IngestionQueue:
+    """
+    Ingestion jobs run one at a time by a background thread, off the request path. The jobs are recorded in a SQLite
+    database in the index store directory, so the status of a job can be read from any worker.
+    """
+    def __init__(self, path, handler, ttl=INGESTION_JOB_TTL):
+        self.path = path
+        self.handler = handler
+        self.ttl = ttl
+        self.after_fork()
+        with closing(sqlite3.connect(self.path, timeout=5)) as conn, conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, url TEXT NOT NULL, status TEXT NOT NULL, "
+                         "chunks INTEGER, error TEXT, submitted REAL NOT NULL, finished REAL)")
+
+    def after_fork(self):
+        # Each process runs its own jobs, the thread is started with the first one
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def execute(self, statement, parameters=()):
+        with closing(sqlite3.connect(self.path, timeout=5)) as conn, conn:
+            conn.row_factory = sqlite3.Row
+            return conn.execute(statement, parameters).fetchall()
+
+    def submit(self, url):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        self.execute("DELETE FROM jobs WHERE finished < ?", (now - self.ttl,))
+        self.execute("INSERT INTO jobs (id, url, status, submitted) VALUES (?, ?, 'queued', ?)", (job_id, url, now))
+        self.queue.put((job_id, url))
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='ingestion', daemon=True)
+                self.thread.start()
+        return job_id
+
+    def status(self, job_id):
+        rows = self.execute("SELECT * FROM jobs WHERE id = ?", (job_id,))
+        return dict(rows[0]) if rows else None
+
+    def run(self):
+        while True:
+            job_id, url = self.queue.get()
+            self.execute("UPDATE jobs SET status = 'running' WHERE id = ?", (job_id,))
+            try:
+                chunks = self.handler(url)
+                self.execute("UPDATE jobs SET status = 'done', chunks = ?, finished = ? WHERE id = ?", (chunks, time.time(), job_id))
+            except Exception as e:
+                error_msg = f"Ingestion of {url} failed: {e}"
+                logger.error(Fore.RED + error_msg)
+                self.execute("UPDATE jobs SET status = 'failed', error = ?, finished = ? WHERE id = ?", (str(e), time.time(), job_id))
+
+class QueryCache:
+    """
+    Two level cache: a bounded in-process LRU with a TTL in front of a SQLite database (WAL mode) shared by the workers.
+    Without a path only the in-process LRU is used. Values must be JSON serializable.
+    Callers include the index version in the key, so a rebuilt index never serves stale entries.
+    """
+    def __init__(self, path, max_entries=1024, ttl=3600, max_persistent_entries=100000):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_persistent_entries = max_persistent_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.writes = 0
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+        if path is None:
+            return
+        conn = self.connection()
+        conn.execute("PRAGMA journal_mode=WAL")
+        with conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)")
+
+    def after_fork(self):
+        # SQLite connections must not be used across a fork, the forked worker opens its own
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def connection(self):
+        # SQLite connections cannot be shared between threads, keep one per thread
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            self.local.conn = conn
+        return conn
+
+    @staticmethod
+    def make_key(*parts):
+        return hashlib.sha256("\0".join(str(part) for part in parts).encode('utf-8')).hexdigest()
+
+    def remember(self, key, value, created):
+        with self.lock:
+            self.entries[key] = (created, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and now - entry[0] < self.ttl:
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                return entry[1]
+            self.entries.pop(key, None)
+        row = None
+        if self.path is not None:
+            row = self.connection().execute("SELECT value, created FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is not None and now - row[1] < self.ttl:
+            value = json.loads(row[0])
+            self.remember(key, value, row[1])
+            with self.lock:
+                self.stats["hits"] += 1
+            return value
+        with self.lock:
+            self.stats["misses"] += 1
         return None
 
-def read_embeddings():
+    def set(self, key, value):
+        now = time.time()
+        self.remember(key, value, now)
+        if self.path is None:
+            return
+        conn = self.connection()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO cache (key, value, created) VALUES (?, ?, ?)", (key, json.dumps(value), now))
+        with self.lock:
+            self.writes += 1
+            prune = self.writes % 100 == 0
+        if prune:
+            self.prune()
+
+    def prune(self):
+        """
+        Drop expired rows and keep the database under max_persistent_entries
+        """
+        conn = self.connection()
+        with conn:
+            expired = conn.execute("DELETE FROM cache WHERE created < ?", (time.time() - self.ttl,)).rowcount
+            overflow = conn.execute(
+                "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY created DESC LIMIT -1 OFFSET ?)",
+                (self.max_persistent_entries,)).rowcount
+        with self.lock:
+            self.stats["evictions"] += expired + overflow
+
+class SemanticCache:
+    """
+    Cache of answered questions indexed by the embedding of the question. A new question is served from the cache
+    when its cosine similarity with a previous question asked on the same index version is above the threshold.
+    """
+    def __init__(self, max_entries=512, threshold=0.98):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.vectors = None
+        self.versions = [None] * max_entries
+        self.values = [None] * max_entries
+        self.lru = OrderedDict()
+        self.free_slots = list(range(max_entries - 1, -1, -1))
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+    @staticmethod
+    def normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def release(self, slot):
+        del self.lru[slot]
+        self.versions[slot] = None
+        self.values[slot] = None
+        self.free_slots.append(slot)
+
+    def lookup(self, embedding, version):
+        query = self.normalize(embedding)
+        with self.lock:
+            slots = [slot for slot in self.lru if self.versions[slot] == version]
+            if slots:
+                scores = self.vectors[slots] @ query
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    self.lru.move_to_end(slots[best])
+                    self.stats["hits"] += 1
+                    return self.values[slots[best]]
+            self.stats["misses"] += 1
+            return None
+
+    def add(self, embedding, version, value):
+        vector = self.normalize(embedding)
+        with self.lock:
+            if self.vectors is None:
+                self.vectors = np.zeros((self.max_entries, vector.shape[0]), dtype=np.float32)
+            # Entries of a previous index version can never be served again
+            for slot in [slot for slot in self.lru if self.versions[slot] != version]:
+                self.release(slot)
+                self.stats["evictions"] += 1
+            if not self.free_slots:
+                self.release(next(iter(self.lru)))
+                self.stats["evictions"] += 1
+            slot = self.free_slots.pop()
+            self.vectors[slot] = vector
+            self.versions[slot] = version
+            self.values[slot] = value
+            self.lru[slot] = None
+
+def serialize_documents(docs):
+    return [{"page_content": doc.page_content, "metadata": doc.metadata} for doc in docs]
+
+def deserialize_documents(docs):
+    return [Document(**doc) for doc in docs]
+
+def index_fingerprint(manifest):
     """
-    Read the embeddings from file
+    Short hash of the index manifest, used to scope cached results to the index they were computed on
     """
-    index_path = os.path.join(INDEX_STORE_DIRECTORY, 'Index.pkl')
-    with open(index_path, 'rb') as f:
-        embeddings = pickle.load(f)
-    return embeddings
+    return hashlib.sha256(json.dumps(manifest, sort_keys=True).encode('utf-8')).hexdigest()[:16]
 
-def search_documents(query, docsearch):
+def reciprocal_rank_fusion(rankings, k):
     """
-    Search the documents for the given query
+    Merge rankings of documents, scoring each document with the sum of 1 / (k + rank) over the rankings
     """
-    if docsearch is None:
+    scores = {}
+    docs = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking, 1):
+            key = chunk_id(doc)
+            docs.setdefault(key, doc)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    return [docs[key] for key in sorted(scores, key=scores.get, reverse=True)]
+
+def lexical_fast_path(query, snapshot):
+    """
+    The BM25 results when the best one is decisive: above LEXICAL_FAST_PATH_SCORE once normalized by the query weight,
+    and LEXICAL_FAST_PATH_RATIO times the second best. The query is then answered without embedding it. Returns None otherwise.
+    """
+    if not (HYBRID_SEARCH and LEXICAL_FAST_PATH):
+        return None
+    results = snapshot.bm25_index.search(query, SEARCH_K)
+    if not results or results[0][1] < LEXICAL_FAST_PATH_SCORE * snapshot.bm25_index.query_weight(query):
+        return None
+    if len(results) > 1 and results[0][1] < LEXICAL_FAST_PATH_RATIO * results[1][1]:
+        return None
+    return [doc for doc, score in results]
+
+def dense_search(snapshot, query_embedding, k):
+    """
+    Nearest chunks of the query embedding. A compact index returns RESCORE_FACTOR times more candidates, which are
+    re-scored against the full precision vectors on disk.
+    """
+    docsearch = snapshot.docsearch
+    query_vector = np.array([query_embedding], dtype=np.float32)
+    if snapshot.full_vectors is None:
+        ids = [int(i) for i in docsearch.index.search(query_vector, k, params=snapshot.search_params)[1][0] if i != -1]
+    else:
+        candidates = docsearch.index.search(query_vector, k * RESCORE_FACTOR, params=snapshot.search_params)[1][0]
+        ids = rescore(snapshot.full_vectors, query_vector[0], candidates, k)
+    return [docsearch.docstore.document(i) for i in ids]
+
+def search_documents(query, snapshot, query_embedding=None):
+    """
+    Search the documents of an index snapshot for the given query, using the query embedding when it was already computed.
+    With HYBRID_SEARCH the dense and the BM25 results are merged by reciprocal rank fusion.
+    """
+    if snapshot.docsearch is None:
         warning_msg = "No index available for searching documents. Skipping search."
         logger.warning(Fore.YELLOW + warning_msg)
         return []
 
     try:
-        cache_path = os.path.join(INDEX_STORE_DIRECTORY, 'openai_cache.pkl')
-        if os.path.exists(cache_path):
-            with open(cache_path, 'rb') as f:
-                cache = pickle.load(f)
-        else:
-            cache = {}
-        
-        if query in cache:
-            docs = cache[query]
-        else:
-            docs = docsearch.similarity_search(query)
-            cache[query] = docs
-            with open(cache_path, 'wb') as f:
-                pickle.dump(cache, f)
-        
+        key = QueryCache.make_key("search", snapshot.version, HYBRID_SEARCH, SEARCH_K, query)
+        cached = query_cache.get(key)
+        if cached is not None:
+            return deserialize_documents(cached)
+
+        candidates = 2 * SEARCH_K if HYBRID_SEARCH else SEARCH_K
+        if query_embedding is None:
+            query_embedding = embeddings.embed_query(query)
+        docs = dense_search(snapshot, query_embedding, candidates)
+        if HYBRID_SEARCH:
+            lexical_docs = [doc for doc, score in snapshot.bm25_index.search(query, candidates)]
+            docs = reciprocal_rank_fusion([docs, lexical_docs], RRF_K)
+        docs = docs[:SEARCH_K]
+        query_cache.set(key, serialize_documents(docs))
         return docs
     except Exception as e:
         error_msg = f"An error occurred during document search: {e}"
         logger.error(Fore.RED + error_msg)
         return []
 
-def answer_question(docs, query):
+def normalize_question(query):
+    """
+    Normalize case and whitespace so trivially different spellings of a question share a cache entry
+    """
+    return re.sub(r'\s+', ' ', query).strip().lower()
+
+def chunk_id(doc):
+    """
+    Content hash identifying a retrieved chunk
+    """
+    source = json.dumps(doc.metadata, sort_keys=True, default=str)
+    return hashlib.sha256((source + "\0" + doc.page_content).encode('utf-8')).hexdigest()[:16]
+
+def overlap_length(first, second, min_overlap=20):
+    """
+    Length of the longest suffix of first that is also a prefix of second, 0 when shorter than min_overlap characters
+    """
+    if len(first) < min_overlap or len(second) < min_overlap:
+        return 0
+    head = second[:min_overlap]
+    start = first.find(head)
+    while start != -1:
+        if second.startswith(first[start:]):
+            return len(first) - start
+        start = first.find(head, start + 1)
+    return 0
+
+def merge_chunks(docs, min_overlap=20):
+    """
+    Merge the chunks of the same source whose text overlaps, as adjacent chunks of split_text() do, and drop the
+    chunks contained in another one. Merged chunks keep the position of their most relevant part.
+    """
+    while True:
+        merged = []
+        for doc in docs:
+            text = doc.page_content
+            for entry in merged:
+                if entry.metadata != doc.metadata:
+                    continue
+                current = entry.page_content
+                if text in current:
+                    break
+                if current in text:
+                    entry.page_content = text
+                    break
+                overlap = overlap_length(current, text, min_overlap)
+                if overlap:
+                    entry.page_content = current + text[overlap:]
+                    break
+                overlap = overlap_length(text, current, min_overlap)
+                if overlap:
+                    entry.page_content = text + current[overlap:]
+                    break
+            else:
+                merged.append(Document(page_content=text, metadata=doc.metadata))
+        # A chunk merged in the middle can bridge two earlier entries, merge again until nothing changes
+        if len(merged) == len(docs):
+            return merged
+        docs = merged
+
+def pack_context(docs, budget):
+    """
+    Pack the retrieved chunks for the "stuff" QA chain: merge the overlapping chunks, then fill the token budget in
+    relevance order. The most relevant chunk is always kept, cut to the budget if needed.
+    Returns the packed documents and the number of prompt tokens saved.
+    """
+    retrieved_tokens = sum(count_tokens(doc.page_content) for doc in docs)
+    packed = []
+    packed_tokens = 0
+    for doc in merge_chunks(docs):
+        tokens = token_encoding.encode(doc.page_content)
+        if packed_tokens + len(tokens) <= budget:
+            packed.append(doc)
+            packed_tokens += len(tokens)
+        elif not packed:
+            packed.append(Document(page_content=token_encoding.decode(tokens[:budget]), metadata=doc.metadata))
+            packed_tokens = budget
+    saved_tokens = retrieved_tokens - packed_tokens
+    with context_stats_lock:
+        context_stats["requests"] += 1
+        context_stats["retrieved_tokens"] += retrieved_tokens
+        context_stats["packed_tokens"] += packed_tokens
+        context_stats["saved_tokens"] += saved_tokens
+    return packed, saved_tokens
+
+def answer_question(docs, query, usage=None):
     """
     Answer the given question using OpenAI's GPT model and searching our own knowledge base. Returns the answer with the SOURCE of the answer.
+    Answers are memoized on the normalized question, the ordered retrieved chunks, the model and the chain type,
+    so a cached answer is only reused when retrieval returned exactly the same context.
+    The chunks are packed into CONTEXT_TOKEN_BUDGET tokens before they are sent to the chain.
     """
-    chain = load_qa_with_sources_chain(OpenAI(model_name=OPENAI_MODEL_NAME, temperature=OPENAI_TEMPERATURE), chain_type="stuff")
-    result = chain.run(input_documents=docs, question=query).strip()
+    key = QueryCache.make_key("answer", OPENAI_MODEL_NAME, OPENAI_TEMPERATURE, QA_CHAIN_TYPE, CONTEXT_TOKEN_BUDGET, normalize_question(query), *[chunk_id(doc) for doc in docs])
+    cached = answer_cache.get(key)
+    if cached is not None:
+        return cached
+    chain = load_qa_with_sources_chain(OpenAI(model_name=OPENAI_MODEL_NAME, temperature=OPENAI_TEMPERATURE), chain_type=QA_CHAIN_TYPE)
+    docs, saved_tokens = pack_context(docs, CONTEXT_TOKEN_BUDGET)
+    if usage is not None:
+        usage["context_tokens_saved"] = usage.get("context_tokens_saved", 0) + saved_tokens
+    with get_openai_callback() as callback:
+        result = chain.run(input_documents=docs, question=query).strip()
+    usage_meter.add(usage, callback.prompt_tokens, callback.completion_tokens)
+    answer_cache.set(key, result)
     return result
 
-def get_prompt(input):
+def record_retrieval(path):
+    with retrieval_stats_lock:
+        retrieval_stats[path] += 1
+
+def search_and_answer(query, usage=None):
+    """
+    Retrieve the documents for the query and answer it from them. The answer of a previous paraphrased question
+    is reused when the semantic cache is enabled and finds a close enough question on the current index version.
+    A decisive lexical match is answered from the BM25 results without embedding the query.
+    """
+    snapshot = live_index
+    if snapshot.docsearch is None:
+        docs = search_documents(query, snapshot)
+        return docs, answer_question(docs, query, usage)
+    docs = lexical_fast_path(query, snapshot)
+    if docs is not None:
+        record_retrieval("lexical_fast_path")
+        return docs, answer_question(docs, query, usage)
+    record_retrieval("hybrid" if HYBRID_SEARCH else "dense")
+    query_embedding = embeddings.embed_query(query)
+    cached = semantic_cache.lookup(query_embedding, snapshot.version) if SEMANTIC_CACHE_ENABLED else None
+    if cached is not None:
+        return deserialize_documents(cached["docs"]), cached["answer"]
+
+    docs = search_documents(query, snapshot, query_embedding)
+    emb_result = answer_question(docs, query, usage)
+    if SEMANTIC_CACHE_ENABLED:
+        semantic_cache.add(query_embedding, snapshot.version, {"docs": serialize_documents(docs), "answer": emb_result})
+    return docs, emb_result
+
+class ConversationStore:
+    """
+    Conversation history per session: the recent turns with their token counts, a running summary and the trimmed
+    turns not summarized yet. Kept in process, or in Redis when a client is given so that all workers share it.
+    """
+    def __init__(self, redis=None, max_sessions=10000, ttl=24 * 3600):
+        self.redis = redis
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def load(self, session_id):
+        if self.redis is not None:
+            value = self.redis.get(f"conversation:{session_id}")
+        else:
+            with self.lock:
+                value = self.sessions.get(session_id)
+                if value is not None:
+                    self.sessions.move_to_end(session_id)
+        return self.decode(value)
+
+    def decode(self, value):
+        return {"summary": "", "turns": [], "trimmed": [], **(json.loads(value) if value else {})}
+
+    def store(self, session_id, value):
+        self.sessions[session_id] = value
+        self.sessions.move_to_end(session_id)
+        while len(self.sessions) > self.max_sessions:
+            self.sessions.popitem(last=False)
+
+    def update(self, session_id, change):
+        """
+        Load, change and save the conversation atomically and return what change() returned. In process the lock is
+        held across the change, with Redis the change runs in a transaction retried if another worker saved in between.
+        """
+        key = f"conversation:{session_id}"
+        if self.redis is not None:
+            def apply(pipe):
+                conversation = self.decode(pipe.get(key))
+                result = change(conversation)
+                pipe.multi()
+                pipe.set(key, json.dumps(conversation), ex=self.ttl)
+                return result
+            return self.redis.transaction(apply, key, value_from_callable=True)
+        with self.lock:
+            conversation = self.decode(self.sessions.get(session_id))
+            result = change(conversation)
+            self.store(session_id, json.dumps(conversation))
+            return result
+
+def count_tokens(text):
+    return len(token_encoding.encode(text))
+
+def count_prompt_tokens(prompt_messages):
     """
-    Create the prompt for the OpenAI GPT model as required by the Chat Completion endpoint.
+    Tokens of a Chat Completion prompt, with the few tokens the API adds to format each message
     """
-    prompt = 'Act as a professional and knowledgeable person'
-    context = []
-    messages.append(input.strip())    
-    print("Prompt : ", prompt)
-    for index, message in enumerate(messages):
-        if index % 2 == 0:
-            context.append({"role": "system", "content": prompt})
-            context.append({"role": "user", "content": message})
+    return sum(count_tokens(message["content"]) + 4 for message in prompt_messages) + 3
+
+class UsageMeter:
+    """
+    Running token counters of the OpenAI calls, per session and for the process. Each call is counted once, from the
+    usage returned by the API, or counted locally for streamed completions which do not return it.
+    Session counters are kept in Redis when a client is given so that all workers add to them.
+    """
+    fields = ("calls", "prompt_tokens", "completion_tokens")
+
+    def __init__(self, prompt_price, completion_price, redis=None, max_sessions=10000, ttl=24 * 3600):
+        self.prompt_price = prompt_price
+        self.completion_price = completion_price
+        self.redis = redis
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self.totals = dict.fromkeys(self.fields, 0)
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def request(self, session_id):
+        """
+        Counters of a single /chat request, passed down to the OpenAI calls it makes
+        """
+        return dict(dict.fromkeys(self.fields, 0), session_id=session_id)
+
+    def add(self, usage, prompt_tokens, completion_tokens):
+        """
+        Count a call in the totals, and in the request and its session when usage is given
+        """
+        counts = {"calls": 1, "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens}
+        session_id = usage["session_id"] if usage is not None else None
+        with self.lock:
+            for name, count in counts.items():
+                self.totals[name] += count
+                if usage is not None:
+                    usage[name] += count
+            if session_id is not None and self.redis is None:
+                session = self.sessions.setdefault(session_id, dict.fromkeys(self.fields, 0))
+                for name, count in counts.items():
+                    session[name] += count
+                self.sessions.move_to_end(session_id)
+                while len(self.sessions) > self.max_sessions:
+                    self.sessions.popitem(last=False)
+        if session_id is not None and self.redis is not None:
+            pipeline = self.redis.pipeline()
+            for name, count in counts.items():
+                pipeline.hincrby(f"usage:{session_id}", name, count)
+            pipeline.expire(f"usage:{session_id}", self.ttl)
+            pipeline.execute()
+
+    def session(self, session_id):
+        if self.redis is not None:
+            counters = {name.decode(): int(value) for name, value in self.redis.hgetall(f"usage:{session_id}").items()}
         else:
-            context.append({"role": "assistant", "content": message})
-    return context
+            with self.lock:
+                counters = dict(self.sessions.get(session_id, {}))
+        return self.report(counters)
+
+    def report(self, counters):
+        report = {name: counters.get(name, 0) for name in self.fields}
+        report["total_tokens"] = report["prompt_tokens"] + report["completion_tokens"]
+        report["cost"] = round((report["prompt_tokens"] * self.prompt_price + report["completion_tokens"] * self.completion_price) / 1000, 6)
+        return report
+
+    @property
+    def stats(self):
+        with self.lock:
+            stats = self.report(self.totals)
+            stats["sessions"] = len(self.sessions)
+        return stats
+
+def record_usage(usage, response):
+    """
+    Count the usage returned by a Chat Completion call
+    """
+    usage_meter.add(usage, response.usage.prompt_tokens, response.usage.completion_tokens)
+
+def get_session_id():
+    """
+    Session of the current request: session_id in the JSON body or the X-Session-Id header
+    """
+    return (request.json or {}).get('session_id') or request.headers.get('X-Session-Id') or 'default'
+
+def build_prompt(session_id, user_input):
+    """
+    Create the prompt for the OpenAI GPT model as required by the Chat Completion endpoint: the system prompt once,
+    with the running summary of the session, then the most recent turns that fit in CONVERSATION_TOKEN_BUDGET.
+    The conversation is not changed, record_turn() adds the turn once it is answered.
+    """
+    conversation = conversations.load(session_id)
+    system_prompt = get_system_prompt()
+    if conversation["summary"]:
+        system_prompt += "\n\nSummary of the earlier conversation: " + conversation["summary"]
+    window = []
+    budget = CONVERSATION_TOKEN_BUDGET
+    for turn in reversed(conversation["turns"]):
+        if turn["tokens"] > budget:
+            break
+        budget -= turn["tokens"]
+        window.append({"role": turn["role"], "content": turn["content"]})
+    window.reverse()
+    return [{"role": "system", "content": system_prompt}] + window + [{"role": "user", "content": user_input.strip()}]
+
+def summarize_turns(summary, turns, usage=None):
+    """
+    Fold the turns trimmed out of the window into the running summary, keeping the old summary if the call fails
+    """
+    transcript = "\n".join(f"{turn['role']}: {turn['content']}" for turn in turns)
+    try:
+        response = openai.ChatCompletion.create(
+            model=OPENAI_MODEL_NAME,
+            messages=[
+                {"role": "system", "content": "Summarize the conversation in a few sentences. Keep the facts, names and decisions needed to continue it."},
+                {"role": "user", "content": f"Summary so far: {summary}\n\nConversation:\n{transcript}"},
+            ],
+            temperature=OPENAI_TEMPERATURE,
+            max_tokens=CONVERSATION_SUMMARY_TOKENS,
+        )
+        record_usage(usage, response)
+        return response.choices[0].message.content.strip()
+    except Exception as e:
+        print("Error: ", e)
+        return summary
+
+def summarize_session(session_id, usage=None):
+    """
+    Fold the trimmed turns of the session into its running summary. The summary is only saved if these turns are
+    still pending, a concurrent task may have folded them already.
+    """
+    conversation = conversations.load(session_id)
+    trimmed = conversation["trimmed"]
+    if not trimmed:
+        return
+    summary = summarize_turns(conversation["summary"], trimmed, usage)
+
+    def fold(conversation):
+        if conversation["trimmed"][:len(trimmed)] == trimmed:
+            conversation["summary"] = summary
+            del conversation["trimmed"][:len(trimmed)]
+
+    conversations.update(session_id, fold)
+
+def record_turn(session_id, user_input, answer, usage=None):
+    """
+    Add a question and its answer to the session. When the history goes over the token budget the oldest turns
+    are trimmed, and compacted into the running summary by a background task if CONVERSATION_SUMMARY is enabled.
+    """
+    turns = [{"role": role, "content": content, "tokens": count_tokens(content)}
+             for role, content in (("user", user_input.strip()), ("assistant", answer))]
+
+    def add_turns(conversation):
+        conversation["turns"].extend(turns)
+        total = sum(turn["tokens"] for turn in conversation["turns"])
+        if total <= CONVERSATION_TOKEN_BUDGET:
+            return False
+        # Trim down to half the budget, so the summary is not rewritten on every turn
+        while conversation["turns"] and total > CONVERSATION_TOKEN_BUDGET // 2:
+            turn = conversation["turns"].pop(0)
+            total -= turn["tokens"]
+            if CONVERSATION_SUMMARY:
+                conversation["trimmed"].append(turn)
+        return bool(conversation["trimmed"])
 
-def create_chat_completion(user_input):    
+    if conversations.update(session_id, add_turns):
+        chat_executor.submit(summarize_session, session_id, usage)
+
+def get_system_prompt():
+    """
+    System prompt sent once at the top of every Chat Completion prompt
+    """
+    return 'Act as a professional and knowledgeable person'
+
+def create_chat_completion(user_input, session_id, usage=None):    
     '''
     Create the chat completion using the OpenAI GPT model.
     '''
     try: 
         completion = openai.ChatCompletion.create(
             model=OPENAI_MODEL_NAME,
-            messages=get_prompt(user_input),
+            messages=build_prompt(session_id, user_input),
             temperature=OPENAI_TEMPERATURE,
             max_tokens=1500,
             n=1
         )
-        messages.append(completion.choices[0].message.content)
+        record_usage(usage, completion)
         completion = completion.choices[0].message.content
         return completion
     except Exception as e:
         print("Error: ", e)
-        response = "OpenAI API Error: ChatCompletion"
+        response = CHAT_COMPLETION_ERROR
     return response
 
+def branch_result(future, timeout, name):
+    """
+    Wait for a chat branch, returning None when it fails or does not finish in time
+    """
+    try:
+        return future.result(timeout=max(timeout, 0))
+    except FutureTimeoutError:
+        warning_msg = f"The {name} branch did not answer within {timeout:.1f}s, using the other branch"
+        logger.warning(Fore.YELLOW + warning_msg)
+    except Exception as e:
+        error_msg = f"The {name} branch failed, using the other branch: {e}"
+        logger.error(Fore.RED + error_msg)
+    return None
+
+def run_chat_branches(user_input, session_id, usage):
+    """
+    Run the RAG answer and the direct ChatCompletion concurrently on the shared chat executor, each with its own timeout.
+    Returns the answer of each branch, None for a branch that failed or timed out.
+    """
+    started = time.time()
+    rag_future = chat_executor.submit(search_and_answer, user_input, usage)
+    completion_future = chat_executor.submit(create_chat_completion, user_input, session_id, usage)
+    rag_result = branch_result(rag_future, RAG_TIMEOUT, "RAG")
+    completion = branch_result(completion_future, COMPLETION_TIMEOUT - (time.time() - started), "ChatCompletion")
+    emb_result = rag_result[1] if rag_result is not None else None
+    if completion == CHAT_COMPLETION_ERROR:
+        completion = None
+    return emb_result, completion
+
 def compare_answers(completion, emb_results):
     '''
     Compare the answers from the two models and return the answer with the highest similarity score.    
@@ -257,14 +2301,11 @@ def compare_answers(completion, emb_results):
     try:
         print("Completion GPT ", completion)
         print("Embeddings GPT ", emb_results)
-        # Vectorize the text data
-        tfidf = TfidfVectorizer()
-        tfidf_matrix = tfidf.fit_transform([completion, emb_results])
-        # Compute the cosine similarity
-        similarity = cosine_similarity(tfidf_matrix[0:1], tfidf_matrix)
+        # Cosine similarity with the corpus IDF weights
+        similarity = AnswerScorer(live_index.bm25_index).score(completion, [emb_results])[0]
         print("Similarity: ", similarity)
         # Return the answer with the highest similarity score
-        if similarity[0][1] > 0.2:
+        if similarity > ANSWER_SIMILARITY_THRESHOLD:
             return completion
         else:
             return emb_results
@@ -273,6 +2314,49 @@ def compare_answers(completion, emb_results):
         response = "Error: Comparison"
     return response
 
+def select_answer(emb_result, completion):
+    """
+    Pick the answer to return: compare both answers, or degrade to the branch that answered
+    """
+    if emb_result is not None and completion is not None:
+        return compare_answers(completion, emb_result)
+    if emb_result is not None or completion is not None:
+        return emb_result if emb_result is not None else completion
+    raise RuntimeError("Both the RAG and the ChatCompletion branches failed")
+
+def collect_chat_completion(prompt_messages, usage=None):
+    """
+    Stream the chat completion into the list of its tokens
+    """
+    return list(stream_chat_completion(prompt_messages, usage))
+
+def stream_chat(user_input, session_id):
+    """
+    Server-sent events for /chat. select_answer() needs both answers, so the ChatCompletion tokens are buffered while
+    the RAG branch runs and only the selected answer is streamed: the ChatCompletion token by token, the RAG answer
+    as a single token. Nothing is sent before both branches finished, so streaming does not lower the time to the
+    first token here. The final event carries the answer and the token info.
+    """
+    started = time.time()
+    usage = usage_meter.request(session_id)
+    rag_future = chat_executor.submit(search_and_answer, user_input, usage)
+    completion_future = chat_executor.submit(collect_chat_completion, build_prompt(session_id, user_input), usage)
+    rag_result = branch_result(rag_future, RAG_TIMEOUT, "RAG")
+    tokens = branch_result(completion_future, COMPLETION_TIMEOUT - (time.time() - started), "ChatCompletion")
+    emb_result = rag_result[1] if rag_result is not None else None
+    completion = "".join(tokens) if tokens is not None else None
+    try:
+        best_answer = select_answer(emb_result, completion)
+    except Exception as e:
+        print(e)
+        yield sse_event({"error": "Huston we have a problem!!!!!!!!"})
+        return
+    for token in (tokens if best_answer == completion else [best_answer]):
+        yield sse_event({"token": token})
+    record_turn(session_id, user_input, best_answer, usage)
+    report = usage_report(usage)
+    yield sse_event({"done": True, "response": best_answer, "token_info": tokens_calc(report), "usage": report})
+
 def summarize_answers(answer1, answer2):
     # Concatenate the two answers
     combined_answer = answer1 + ' ' + answer2
@@ -280,7 +2364,7 @@ def summarize_answers(answer1, answer2):
         # Use the OpenAI GPT-3 model to generate a summary
         response = openai.ChatCompletion.create(
             engine=OPENAI_MODEL_NAME,
-            messages=get_prompt(combined_answer),
+            messages=[{"role": "user", "content": combined_answer}],
             temperature=0.5,
             max_tokens=2000,
             top_p=1,
@@ -291,19 +2375,103 @@ def summarize_answers(answer1, answer2):
         print("Error: ", e)
         response = "OpenAI API Error: Summarization"
 
-def tokens_calc():
-    enc = tiktoken.get_encoding("cl100k_base")
-    count_tokens = len(enc.encode(" ".join(messages)))
-    cost = count_tokens / 1000 * 0.002
-    return "Used tokens: " + str(count_tokens) + " (" + format(cost, '.5f') + " USD)"
+def stream_chat_completion(prompt_messages, usage=None):
+    """
+    Stream the chat completion and yield the content tokens as they arrive. Streamed responses carry no usage,
+    the prompt and the tokens received are counted locally once the stream ends or is closed.
+    """
+    response = openai.ChatCompletion.create(
+        model=OPENAI_MODEL_NAME,
+        messages=prompt_messages,
+        temperature=OPENAI_TEMPERATURE,
+        max_tokens=1500,
+        n=1,
+        stream=True
+    )
+    received = []
+    try:
+        for chunk in response:
+            token = chunk.choices[0].delta.get("content")
+            if token:
+                received.append(token)
+                yield token
+    finally:
+        usage_meter.add(usage, count_prompt_tokens(prompt_messages), count_tokens("".join(received)))
+
+def sse_event(data):
+    """
+    Format a server-sent event carrying a JSON payload
+    """
+    return f"data: {json.dumps(data)}\n\n"
+
+def sse_response(events):
+    """
+    Stream the events to the client without buffering
+    """
+    return Response(stream_with_context(events), mimetype='text/event-stream',
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+def wants_stream():
+    """
+    Check if the client asked for a streamed /chat response
+    """
+    return bool(request.json.get('stream')) or 'text/event-stream' in request.headers.get('Accept', '')
+
+def usage_report(usage):
+    """
+    Tokens and cost of the request and of its whole session
+    """
+    request_usage = usage_meter.report(usage)
+    request_usage["context_tokens_saved"] = usage.get("context_tokens_saved", 0)
+    return {"request": request_usage, "session": usage_meter.session(usage["session_id"])}
+
+def index_ready():
+    """
+    The index is ready when it was loaded or built, or when there are no sources to index
+    """
+    return live_index.docsearch is not None or not (manifest["pdfs"] or manifest["webpages"] or manifest["submitted_urls"])
+
+def after_fork():
+    """
+    Called in each worker forked by the pre-fork server (gunicorn.conf.py). The index, the chunk store and the caches
+    are inherited from the master, only the connections, the locks and the threads are created again.
+    """
+    global http_session, chat_executor, index_lock, pending_urls_lock, host_semaphores, host_semaphores_lock, context_stats_lock, retrieval_stats_lock
+    # A lock held by a thread of the master when it forked would stay locked in the worker
+    index_lock = threading.Lock()
+    pending_urls_lock = threading.Lock()
+    host_semaphores = {}
+    host_semaphores_lock = threading.Lock()
+    context_stats_lock = threading.Lock()
+    retrieval_stats_lock = threading.Lock()
+    for shared in (embeddings, live_index.bm25_index, semantic_cache, conversations, usage_meter):
+        shared.lock = threading.Lock()
+    if live_index.docsearch is not None:
+        live_index.docsearch.docstore.lock = threading.Lock()
+    http_session = create_http_session()
+    embeddings.embeddings.after_fork()
+    query_cache.after_fork()
+    answer_cache.after_fork()
+    chat_executor = ThreadPoolExecutor(max_workers=CHAT_EXECUTOR_WORKERS)
+    ingestion_queue.after_fork()
+    start_document_watcher()
+
+def tokens_calc(report):
+    request_usage, session_usage = report["request"], report["session"]
+    return "Used tokens: " + str(request_usage["total_tokens"]) + " (" + format(request_usage["cost"], '.5f') + " USD), session: " + str(session_usage["total_tokens"]) + " (" + format(session_usage["cost"], '.5f') + " USD)"
 
 # Logic
-raw_text = read_from_webpages_url()
-raw_text.extend(read_from_PDF())
-texts = split_text(raw_text)
-embeddings = create_embeddings(texts)
-embeddings = read_embeddings()
-docsearch = create_index(texts, embeddings)
+http_session = create_http_session()
+embeddings = create_embeddings()
+load_startup_index()
+ingestion_queue = IngestionQueue(os.path.join(INDEX_STORE_DIRECTORY, 'ingestion_jobs.sqlite3'), add_webpage)
+query_cache = QueryCache(os.path.join(INDEX_STORE_DIRECTORY, 'query_cache.sqlite3'), QUERY_CACHE_SIZE, QUERY_CACHE_TTL)
+answer_cache_path = os.path.join(INDEX_STORE_DIRECTORY, 'answer_cache.sqlite3') if ANSWER_CACHE_PERSIST else None
+answer_cache = QueryCache(answer_cache_path, ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL)
+semantic_cache = SemanticCache(SEMANTIC_CACHE_SIZE, SEMANTIC_CACHE_THRESHOLD)
+chat_executor = ThreadPoolExecutor(max_workers=CHAT_EXECUTOR_WORKERS)
+conversations = ConversationStore(redis_client if CONVERSATION_BACKEND == 'redis' else None)
+usage_meter = UsageMeter(PROMPT_TOKEN_PRICE, COMPLETION_TOKEN_PRICE, redis_client if CONVERSATION_BACKEND == 'redis' else None)
 
 # Routes
 @api.route('/chat')
@@ -313,16 +2481,19 @@ class chat(Resource):
      while True:
             try:
                 user_input = request.json.get('input')
+                session_id = get_session_id()
+                if wants_stream():
+                    return sse_response(stream_chat(user_input, session_id))
                 # Queries 
-                docs = search_documents( user_input, docsearch)
-                emb_result = answer_question(docs, user_input)
-                completion = create_chat_completion(user_input)
-                # Compare the answers
-                best_answer = compare_answers(completion, emb_result)
+                usage = usage_meter.request(session_id)
+                emb_result, completion = run_chat_branches(user_input, session_id, usage)
+                # Compare the answers, or degrade to the branch that answered
+                best_answer = select_answer(emb_result, completion)
                 # Summarize the answers
                 #best_answer2 = summarize_answers(emb_result, completion)
-                token_info = tokens_calc()
-                return jsonify({"response": best_answer, "token_info": token_info})  
+                record_turn(session_id, user_input, best_answer, usage)
+                report = usage_report(usage)
+                return jsonify({"response": best_answer, "token_info": tokens_calc(report), "usage": report})  
             except Exception as Oooooops:
                 print(Oooooops)
             return jsonify({"response": "Huston we have a problem!!!!!!!! %s" %"}"}), 500
@@ -341,27 +2512,65 @@ class Roles(Resource):
 
 @api.route('/webpage')
 class Webpage(Resource):
-    @api.doc(responses={200: 'Success', 400: 'Bad Request'}, description='Webpage endpoint')
+    @api.doc(responses={200: 'Already indexed', 202: 'Ingestion job queued', 400: 'Bad Request'}, description='Webpage endpoint')
     def post(self):
         import traceback
         try:
-            global raw_text, texts, embeddings, docsearch
-            
             data = request.get_json()
-            webpage = data.get('webpage')
-            new_content = read_from_web(webpage)
-            raw_text.extend(new_content)
-            
-            texts = split_text(raw_text)
-            embeddings = create_embeddings(texts)
-            embeddings = read_embeddings()
-            docsearch = create_index(texts, embeddings)
-            return jsonify({"status": "success", "message": "New URL submitted successfully to your embeddings."})
+            webpage = (data.get('webpage') or '').strip()
+            if not webpage:
+                response = jsonify({"status": "error", "message": "No webpage URL provided."})
+                response.status_code = 400
+                return response
+            job_id = queue_webpage(webpage)
+            if job_id is None:
+                return jsonify({"status": "success", "message": "This URL is already in your embeddings."})
+            response = jsonify({"status": "queued", "job_id": job_id, "message": "New URL queued for your embeddings."})
+            response.status_code = 202
+            return response
 
         except Exception as Oops:
             print(traceback.format_exc())
             print(Oops)
-            return jsonify({"status": "error", "message": "An error occurred while processing the webpage. Please try again."}), 400
+            response = jsonify({"status": "error", "message": "An error occurred while processing the webpage. Please try again."})
+            response.status_code = 400
+            return response
+
+@api.route('/webpage/<string:job_id>')
+class WebpageJob(Resource):
+    @api.doc(responses={200: 'Success', 404: 'Unknown job'}, description='Status of an ingestion job: queued, running, done or failed')
+    def get(self, job_id):
+        job = ingestion_queue.status(job_id)
+        if job is None:
+            response = jsonify({"status": "error", "message": "Unknown job."})
+            response.status_code = 404
+            return response
+        return jsonify(job)
+
+@api.route('/metrics')
+class Metrics(Resource):
+    @api.doc(responses={200: 'Success'}, description='Cache and index metrics')
+    def get(self):
+        return jsonify({
+            "index_version": live_index.version,
+            "query_cache": query_cache.stats,
+            "semantic_cache": semantic_cache.stats,
+            "answer_cache": answer_cache.stats,
+            "embedding_cache": {"hits": embeddings.hits, "misses": embeddings.misses},
+            "embedding_executor": embeddings.embeddings.stats,
+            "usage": usage_meter.stats,
+            "context_packing": context_stats,
+            "retrieval": dict(retrieval_stats, bm25_documents=len(live_index.bm25_index)),
+            "ingestion_pending": len(pending_urls),
+        })
+
+@api.route('/ready')
+class Ready(Resource):
+    @api.doc(responses={200: 'Ready', 503: 'Index not loaded'}, description='Readiness probe for the load balancer')
+    def get(self):
+        response = jsonify({"ready": index_ready(), "index_version": live_index.version, "pid": os.getpid()})
+        response.status_code = 200 if index_ready() else 503
+        return response
 
 @api.errorhandler(ConnectionError)
 def handle_connection_error(e):
@@ -429,4 +2638,10 @@ class DeleteRole(Resource):
             return handle_connection_error(e)
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    if '--evaluate-index' in sys.argv:
+        print(json.dumps(evaluate_index(), indent=2))
+    else:
+        # The reloader runs the app in a child process, only that one watches the documents
+        if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            start_document_watcher()
+        app.run(debug=True)
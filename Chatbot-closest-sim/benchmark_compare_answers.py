@@ -0,0 +1,35 @@
+"""
+Microbenchmark of the answer similarity used by compare_answers(): a TfidfVectorizer fitted on the two answers
+for every request against the AnswerScorer fitted once on the indexed corpus.
+
+Run from this directory with the same .env as the chatbot: python benchmark_compare_answers.py
+"""
+import timeit
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.metrics.pairwise import cosine_similarity
+from Chatbot import AnswerScorer, live_index
+
+COMPLETION = ("The quarterly report shows that revenue grew by ten percent, mostly from the new maintenance contracts. "
+              "Operating costs were stable and the pump product line remained the largest source of income.")
+CANDIDATES = [
+    "Revenue grew by ten percent in the quarter, driven by maintenance contracts. SOURCES: report.pdf",
+    "I don't know the answer to this question.",
+    "The pump line is still the largest source of income and costs did not change. SOURCES: report.pdf",
+    "Error code E-1042 means the controller lost the pressure sensor signal. SOURCES: manual.pdf",
+] * 2
+NUMBER = 2000
+answer_scorer = AnswerScorer(live_index.bm25_index)
+
+def tfidf_per_request(completion, answer):
+    tfidf_matrix = TfidfVectorizer().fit_transform([completion, answer])
+    return cosine_similarity(tfidf_matrix[0:1], tfidf_matrix)[0][1]
+
+def report(name, seconds, calls):
+    print(f"{name:<45} {seconds / calls * 1e6:10.1f} us/call")
+
+if __name__ == '__main__':
+    print(f"Corpus: {len(live_index.bm25_index)} chunks, {NUMBER} calls per measure\n")
+    report("TfidfVectorizer per request, 1 answer", timeit.timeit(lambda: tfidf_per_request(COMPLETION, CANDIDATES[0]), number=NUMBER), NUMBER)
+    report("AnswerScorer, 1 answer", timeit.timeit(lambda: answer_scorer.score(COMPLETION, CANDIDATES[:1]), number=NUMBER), NUMBER)
+    report(f"TfidfVectorizer per request, {len(CANDIDATES)} answers", timeit.timeit(lambda: [tfidf_per_request(COMPLETION, answer) for answer in CANDIDATES], number=NUMBER), NUMBER)
+    report(f"AnswerScorer batch, {len(CANDIDATES)} answers", timeit.timeit(lambda: answer_scorer.score(COMPLETION, CANDIDATES), number=NUMBER), NUMBER)
@@ -1,8 +1,11 @@
 import os
+import json
 import openai
+import threading
+from collections import OrderedDict
 import tiktoken
 from dotenv import load_dotenv
-from flask import Flask, request, jsonify, render_template
+from flask import Flask, Response, request, jsonify, render_template, stream_with_context
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -17,36 +20,134 @@ if not OPENAI_MODEL_NAME:
 
 load_dotenv()
 openai.api_key = os.getenv('OPENAI_API_KEY')
+# Tokens of history sent with each question, the oldest turns are dropped first
+CONVERSATION_TOKEN_BUDGET = int(os.getenv('CONVERSATION_TOKEN_BUDGET', '2000'))
+MAX_SESSIONS = int(os.getenv('MAX_SESSIONS', '10000'))
+# USD per 1K tokens
+PROMPT_TOKEN_PRICE = float(os.getenv('PROMPT_TOKEN_PRICE', '0.002'))
+COMPLETION_TOKEN_PRICE = float(os.getenv('COMPLETION_TOKEN_PRICE', '0.002'))
 
 app = Flask(__name__)
 
-messages = []
+enc = tiktoken.get_encoding("cl100k_base")
+# Conversation turns and token usage per session, the least recently used sessions are dropped past MAX_SESSIONS
+sessions = OrderedDict()
+sessions_lock = threading.Lock()
+usage_totals = {"calls": 0, "prompt_tokens": 0, "completion_tokens": 0}
 
-def get_prompt(input):
+def get_session(session_id):
+    session = sessions.setdefault(session_id, {"turns": [], "calls": 0, "prompt_tokens": 0, "completion_tokens": 0})
+    sessions.move_to_end(session_id)
+    while len(sessions) > MAX_SESSIONS:
+        sessions.popitem(last=False)
+    return session
+
+def get_turns(session_id):
+    with sessions_lock:
+        return list(get_session(session_id)["turns"])
+
+def get_prompt(session_id, input):
+    """
+    The most recent turns of the session that fit in CONVERSATION_TOKEN_BUDGET, then the question
+    """
     context = []
-    messages.append(input)
-    for index, message in enumerate(messages):
-        if index % 2 == 0:
-            context.append({"role": "user", "content": message})
-        else:
-            context.append({"role": "assistant", "content": message})
+    budget = CONVERSATION_TOKEN_BUDGET
+    for turn in reversed(get_turns(session_id)):
+        if turn["tokens"] > budget:
+            break
+        budget -= turn["tokens"]
+        context.append({"role": turn["role"], "content": turn["content"]})
+    context.reverse()
+    context.append({"role": "user", "content": input})
     return context
 
-def create_chat_completion(input):
+def count_prompt_tokens(prompt):
+    """
+    Tokens of a prompt, with the few tokens the API adds to format each message
+    """
+    return sum(len(enc.encode(message["content"])) + 4 for message in prompt) + 3
+
+def add_usage(session_id, prompt_tokens, completion_tokens):
+    """
+    Count a call in the session and in the totals, each message is only encoded once
+    """
+    usage = {"calls": 1, "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens}
+    with sessions_lock:
+        session = get_session(session_id)
+        for name, count in usage.items():
+            session[name] += count
+            usage_totals[name] += count
+    return usage
+
+def record_turn(session_id, input, answer):
+    with sessions_lock:
+        turns = get_session(session_id)["turns"]
+        for role, content in (("user", input), ("assistant", answer)):
+            turns.append({"role": role, "content": content, "tokens": len(enc.encode(content))})
+        # Keep at most twice the budget, older turns would never be sent again
+        while sum(turn["tokens"] for turn in turns) > 2 * CONVERSATION_TOKEN_BUDGET:
+            turns.pop(0)
+
+def create_chat_completion(session_id, input):
+    """
+    Returns the answer and the usage reported by the API
+    """
+    completion = openai.ChatCompletion.create(
+        model=OPENAI_MODEL_NAME,
+        messages=get_prompt(session_id, input),
+        temperature=0,
+        max_tokens=1000,
+    )
+    record_turn(session_id, input, completion.choices[0].message.content)
+    usage = add_usage(session_id, completion.usage.prompt_tokens, completion.usage.completion_tokens)
+    return completion.choices[0].message.content, usage
+
+def stream_chat_completion(prompt):
     completion = openai.ChatCompletion.create(
         model=OPENAI_MODEL_NAME,
-        messages=get_prompt(input),
+        messages=prompt,
         temperature=0,
         max_tokens=1000,
+        stream=True,
     )
-    messages.append(completion.choices[0].message.content)
-    return completion.choices[0].message.content
+    for chunk in completion:
+        token = chunk.choices[0].delta.get("content")
+        if token:
+            yield token
 
-def tokens_calc():
-    enc = tiktoken.get_encoding("cl100k_base")
-    count_tokens = len(enc.encode(" ".join(messages)))
-    cost = count_tokens / 1000 * 0.002
-    return "Used tokens: " + str(count_tokens) + " (" + format(cost, '.5f') + " USD)"
+def stream_chat(session_id, input):
+    """
+    Server-sent events: one event per token as it arrives, then a final event with the full answer and the token info
+    """
+    tokens = []
+    prompt = get_prompt(session_id, input)
+    try:
+        for token in stream_chat_completion(prompt):
+            tokens.append(token)
+            yield f"data: {json.dumps({'token': token})}\n\n"
+    except Exception as e:
+        print("Error: ", e)
+        yield f"data: {json.dumps({'error': 'OpenAI API Error: ChatCompletion'})}\n\n"
+        return
+    completion = "".join(tokens)
+    record_turn(session_id, input, completion)
+    # Streamed responses carry no usage, count the prompt and the answer locally
+    usage = add_usage(session_id, count_prompt_tokens(prompt), len(enc.encode(completion)))
+    yield f"data: {json.dumps({'done': True, 'response': completion, 'token_info': tokens_calc(session_id, usage)})}\n\n"
+
+def usage_cost(usage):
+    return (usage["prompt_tokens"] * PROMPT_TOKEN_PRICE + usage["completion_tokens"] * COMPLETION_TOKEN_PRICE) / 1000
+
+def tokens_calc(session_id, usage):
+    """
+    Tokens and cost of the request and of the whole session
+    """
+    with sessions_lock:
+        session = get_session(session_id)
+        session_tokens = session["prompt_tokens"] + session["completion_tokens"]
+        session_cost = usage_cost(session)
+    request_tokens = usage["prompt_tokens"] + usage["completion_tokens"]
+    return "Used tokens: " + str(request_tokens) + " (" + format(usage_cost(usage), '.5f') + " USD), session: " + str(session_tokens) + " (" + format(session_cost, '.5f') + " USD)"
 
 @app.route('/')
 def index():
@@ -54,10 +155,21 @@ def index():
 
 @app.route('/chat', methods=['POST'])
 def chat():
-    user_input = request.json.get('input')
-    completion = create_chat_completion(user_input)
-    token_info = tokens_calc()
-    return jsonify({"response": completion, "token_info": token_info})
+    user_input = request.json.get('input').strip()
+    session_id = request.json.get('session_id') or request.headers.get('X-Session-Id') or 'default'
+    if request.json.get('stream') or 'text/event-stream' in request.headers.get('Accept', ''):
+        return Response(stream_with_context(stream_chat(session_id, user_input)), mimetype='text/event-stream',
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    completion, usage = create_chat_completion(session_id, user_input)
+    token_info = tokens_calc(session_id, usage)
+    return jsonify({"response": completion, "token_info": token_info, "usage": dict(usage, cost=round(usage_cost(usage), 6))})
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    with sessions_lock:
+        usage = dict(usage_totals, sessions=len(sessions))
+    usage["cost"] = round(usage_cost(usage), 6)
+    return jsonify({"usage": usage})
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -4,6 +4,13 @@ document.addEventListener('DOMContentLoaded', () => {
     const chatbox = document.getElementById('chatbox');
     const tokenInfoElement = document.getElementById('token-info');
 
+    // One conversation per browser, kept across page reloads
+    let sessionId = localStorage.getItem('session_id');
+    if (!sessionId) {
+        sessionId = window.crypto && crypto.randomUUID ? crypto.randomUUID() : Date.now().toString(36) + Math.random().toString(36).slice(2);
+        localStorage.setItem('session_id', sessionId);
+    }
+
     const appendMessage = (role, content) => {
         const messageContainer = document.createElement('div');
         messageContainer.className = role === 'user' ? 'user-message' : 'bot-message';
@@ -18,6 +25,26 @@ document.addEventListener('DOMContentLoaded', () => {
 
         chatbox.appendChild(messageContainer);
         chatbox.scrollTop = chatbox.scrollHeight;
+        return contentElement;
+    };
+
+    // Read the server-sent events of a streamed response and pass each JSON payload to onEvent
+    const readEvents = async (response, onEvent) => {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        while (true) {
+            const { done, value } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            const events = buffer.split('\n\n');
+            buffer = events.pop();
+            for (const event of events) {
+                if (event.startsWith('data: ')) {
+                    onEvent(JSON.parse(event.slice(6)));
+                }
+            }
+        }
     };
 
     const sendMessage = async () => {
@@ -33,16 +60,28 @@ document.addEventListener('DOMContentLoaded', () => {
                 headers: {
                     'Content-Type': 'application/json',
                 },
-                body: JSON.stringify({ input: userInput }),
+                body: JSON.stringify({ input: userInput, session_id: sessionId, stream: true }),
             });
 
             if (!response.ok) {
                 throw new Error('Network response was not ok');
             }
 
-            const data = await response.json();
-            appendMessage('assistant', data.response);
-            tokenInfoElement.textContent = data.token_info;
+            // Render the answer token by token, the final event carries the full answer and the token info
+            const contentElement = appendMessage('assistant', '');
+            await readEvents(response, (event) => {
+                if (event.token) {
+                    contentElement.textContent += event.token;
+                    chatbox.scrollTop = chatbox.scrollHeight;
+                }
+                if (event.error) {
+                    contentElement.textContent = event.error;
+                }
+                if (event.done) {
+                    contentElement.textContent = event.response;
+                    tokenInfoElement.textContent = event.token_info;
+                }
+            });
 
         } catch (error) {
             console.error('There was a problem with the fetch operation:', error);
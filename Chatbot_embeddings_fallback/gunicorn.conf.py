@@ -0,0 +1,35 @@
+"""
+Pre-fork serving: the master imports Chatbot once (preload_app), which loads or builds the FAISS index, the chunk store
+and the caches, then forks the workers. The workers share these pages copy-on-write instead of each building its own
+index. Start with: gunicorn -c gunicorn.conf.py Chatbot:app
+"""
+import gc
+import os
+import multiprocessing
+
+bind = os.getenv('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = int(os.getenv('GUNICORN_THREADS', 8))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 120))
+preload_app = True
+# Written once the master has loaded the index and the workers can be forked, for container readiness checks
+READY_FILE = os.getenv('READY_FILE')
+
+def pre_fork(server, worker):
+    # Move the objects of the loaded app out of the collected generations so the garbage collector of the workers
+    # does not write to (and copy) the shared pages
+    gc.freeze()
+
+def post_fork(server, worker):
+    from Chatbot import after_fork
+    after_fork()
+
+def when_ready(server):
+    if READY_FILE:
+        with open(READY_FILE, 'w') as f:
+            f.write(str(os.getpid()))
+
+def on_exit(server):
+    if READY_FILE and os.path.exists(READY_FILE):
+        os.remove(READY_FILE)
@@ -6,6 +6,13 @@ document.addEventListener('DOMContentLoaded', () => {
     const webpageBtn = document.getElementById('webpage-btn');
     const webpageInput = document.getElementById('webpage-input');
 
+    // One conversation per browser, kept across page reloads
+    let sessionId = localStorage.getItem('session_id');
+    if (!sessionId) {
+        sessionId = window.crypto && crypto.randomUUID ? crypto.randomUUID() : Date.now().toString(36) + Math.random().toString(36).slice(2);
+        localStorage.setItem('session_id', sessionId);
+    }
+
     const appendMessage = (role, content) => {
         const messageContainer = document.createElement('div');
         messageContainer.className = role === 'user' ? 'user-message' : 'bot-message';
@@ -20,6 +27,26 @@ document.addEventListener('DOMContentLoaded', () => {
 
         chatbox.appendChild(messageContainer);
         chatbox.scrollTop = chatbox.scrollHeight;
+        return contentElement;
+    };
+
+    // Read the server-sent events of a streamed response and pass each JSON payload to onEvent
+    const readEvents = async (response, onEvent) => {
+        const reader = response.body.getReader();
+        const decoder = new TextDecoder();
+        let buffer = '';
+        while (true) {
+            const { done, value } = await reader.read();
+            if (done) break;
+            buffer += decoder.decode(value, { stream: true });
+            const events = buffer.split('\n\n');
+            buffer = events.pop();
+            for (const event of events) {
+                if (event.startsWith('data: ')) {
+                    onEvent(JSON.parse(event.slice(6)));
+                }
+            }
+        }
     };
 
     const sendMessage = async () => {
@@ -35,16 +62,28 @@ document.addEventListener('DOMContentLoaded', () => {
                 headers: {
                     'Content-Type': 'application/json',
                 },
-                body: JSON.stringify({ input: userInput }),
+                body: JSON.stringify({ input: userInput, session_id: sessionId, stream: true }),
             });
 
             if (!response.ok) {
                 throw new Error('Network response was not ok');
             }
 
-            const data = await response.json();
-            appendMessage('assistant', data.response);
-            tokenInfoElement.textContent = data.token_info;
+            // Render the answer token by token, the final event carries the full answer and the token info
+            const contentElement = appendMessage('assistant', '');
+            await readEvents(response, (event) => {
+                if (event.token) {
+                    contentElement.textContent += event.token;
+                    chatbox.scrollTop = chatbox.scrollHeight;
+                }
+                if (event.error) {
+                    contentElement.textContent = event.error;
+                }
+                if (event.done) {
+                    contentElement.textContent = event.response;
+                    tokenInfoElement.textContent = event.token_info;
+                }
+            });
 
         } catch (error) {
             console.error('There was a problem with the fetch operation:', error);
@@ -69,11 +108,31 @@ document.addEventListener('DOMContentLoaded', () => {
     
             const data = await response.json();
             appendMessage('assistant', data.message);
+            if (data.job_id) {
+                pollWebpageJob(data.job_id);
+            }
     
         } catch (error) {
             console.error('There was a problem with the fetch operation:', error);
             appendMessage('assistant', 'An error occurred while processing the webpage. Please try again.');
         }
+    };
+
+    // The page is indexed in the background, report when its ingestion job is finished
+    const pollWebpageJob = async (jobId) => {
+        try {
+            const response = await fetch(`/webpage/${jobId}`);
+            const job = await response.json();
+            if (job.status === 'done') {
+                appendMessage('assistant', `${job.url} was added to your embeddings.`);
+            } else if (job.status === 'failed') {
+                appendMessage('assistant', `${job.url} could not be added to your embeddings: ${job.error}`);
+            } else {
+                setTimeout(() => pollWebpageJob(jobId), 1000);
+            }
+        } catch (error) {
+            console.error('There was a problem with the fetch operation:', error);
+        }
     };    
 
     sendBtn.addEventListener('click', sendMessage);
@@ -12,9 +12,106 @@ Keep in mind that these tests are just a starting point.
 You can add more test cases and improve the existing ones based on the specific requirements and expected behavior of your application. 
 Additionally, consider using mock or unittest.mock libraries to mock external services or functions as needed to isolate your tests and avoid relying on external dependencies.
 '''
+import os
 import unittest
 import json
-from Chatbot import app
+import time
+import tempfile
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+import numpy as np
+import faiss
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from langchain.docstore.document import Document
+import Chatbot
+from Chatbot import app, fetch_webpages, EmbeddingExecutor, UsageMeter, merge_chunks, BM25Index, build_ann_index, rescore, ChunkStore, IngestionQueue, search_parameters
+
+class HashEmbeddings:
+    """
+    Deterministic embeddings derived from a hash of the text, no API calls
+    """
+    def embed_documents(self, texts):
+        return [self.embed_query(text) for text in texts]
+
+    def embed_query(self, text):
+        return np.frombuffer(hashlib.sha256(text.encode('utf-8')).digest(), dtype=np.uint8)[:8].astype(np.float32).tolist()
+
+class FailingEmbeddings(HashEmbeddings):
+    """
+    Embeddings of an unreachable API, only loading an index works
+    """
+    def embed_documents(self, texts):
+        raise ConnectionError("Embeddings API unreachable")
+
+class SlowPageHandler(BaseHTTPRequestHandler):
+    """
+    Local web page server answering after a fixed delay, 404 for /missing, a UTF-8 page without a charset header for /utf8
+    """
+    delay = 0.5
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        if self.path == '/missing':
+            self.send_response(404)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.end_headers()
+        if self.path == '/utf8':
+            self.wfile.write('<html><head><meta charset="utf-8"><title>Café</title></head><body>Müller straße – 東京</body></html>'.encode('utf-8'))
+            return
+        self.wfile.write(b"<html><head><title>Test page</title></head><body>Some content</body></html>")
+
+    def log_message(self, format, *args):
+        pass
+
+class StubEmbeddingHandler(BaseHTTPRequestHandler):
+    """
+    Local stand-in for the embeddings endpoint, answers 429 to the first request
+    """
+    requests_count = 0
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        StubEmbeddingHandler.requests_count += 1
+        if StubEmbeddingHandler.requests_count == 1:
+            self.send_response(429)
+            self.send_header('Retry-After', '0.01')
+            self.end_headers()
+            return
+        data = [{"index": i, "embedding": [float(len(text)), 1.0]} for i, text in enumerate(body["input"])]
+        payload = json.dumps({"data": data}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+class SlowEmbeddingHandler(BaseHTTPRequestHandler):
+    """
+    Local stand-in for the embeddings endpoint, answers every request after a fixed delay
+    """
+    delay = 0.3
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        time.sleep(self.delay)
+        data = [{"index": i, "embedding": [float(len(text)), 1.0]} for i, text in enumerate(body["input"])]
+        payload = json.dumps({"data": data}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
 
 class TestApp(unittest.TestCase):
 
@@ -28,8 +125,26 @@ class TestApp(unittest.TestCase):
     def test_submit_webpage(self):
         test_url = "https://www.google.com"
         response = self.app.post('/webpage', json={"webpage": test_url})
+        self.assertEqual(response.status_code, 202)
+        job_id = json.loads(response.data)["job_id"]
+        response = self.app.get(f'/webpage/{job_id}')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(json.loads(response.data)["status"], ("queued", "running", "done", "failed"))
+        self.assertEqual(self.app.get('/webpage/unknown').status_code, 404)
+
+    def test_submit_empty_webpage(self):
+        for data in ({}, {"webpage": ""}, {"webpage": "   "}):
+            response = self.app.post('/webpage', json=data)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(json.loads(response.data)["message"], "No webpage URL provided.")
+
+    def test_submit_duplicate_webpage(self):
+        test_url = "https://www.example.com"
+        self.app.post('/webpage', json={"webpage": test_url})
+        response = self.app.post('/webpage', json={"webpage": test_url})
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(response.data.decode("utf-8"), 'URL submitted successfully')
+        data = json.loads(response.data)
+        self.assertEqual(data["message"], "This URL is already in your embeddings.")
 
     def test_chat(self):
         test_input = "What is AI?"
@@ -39,5 +154,465 @@ class TestApp(unittest.TestCase):
         self.assertIn("response", data)
         self.assertIn("token_info", data)
 
+    def test_hedged_answer(self):
+        def stream(prompt_messages, usage=None):
+            time.sleep(0.1)
+            yield from ("Direct ", "answer")
+
+        def failing_stream(prompt_messages, usage=None):
+            raise RuntimeError("ChatCompletion failed")
+            yield
+
+        def rag(answer, delay=0.0):
+            def search_and_answer(user_input, usage=None):
+                time.sleep(delay)
+                return [], answer
+            return search_and_answer
+
+        unusable = Chatbot.FALLBACK_SENTENCES[0]
+        with mock.patch.multiple(Chatbot, hedge_stats={}, HEDGE_DELAY=0.2, stream_chat_completion=stream,
+                                 build_prompt=lambda session_id, user_input: [{"role": "user", "content": user_input}]):
+            # A usable RAG answer within the hedge delay cancels the hedge before it starts, or builds its prompt
+            unavailable = mock.Mock(side_effect=ConnectionError("Redis server not available"))
+            with mock.patch.multiple(Chatbot, search_and_answer=rag("RAG answer"), build_prompt=unavailable):
+                emb_result, hedge = Chatbot.hedged_answer("question", "hedge-test", None, "fast")
+            self.assertEqual((emb_result, hedge), ("RAG answer", None))
+            unavailable.assert_not_called()
+            # A usable RAG answer after the hedge delay discards the tokens of the started hedge
+            with mock.patch.object(Chatbot, 'search_and_answer', rag("RAG answer", 0.3)):
+                emb_result, hedge = Chatbot.hedged_answer("question", "hedge-test", None, "slow")
+            self.assertEqual((emb_result, hedge), ("RAG answer", None))
+            # An unusable RAG answer starts the hedge without waiting for the delay
+            started = time.time()
+            with mock.patch.object(Chatbot, 'search_and_answer', rag(unusable)):
+                emb_result, hedge = Chatbot.hedged_answer("question", "hedge-test", None, "fallback")
+                self.assertEqual("".join(hedge), "Direct answer")
+            self.assertLess(time.time() - started, 0.2)
+            with mock.patch.multiple(Chatbot, search_and_answer=rag(unusable), stream_chat_completion=failing_stream):
+                emb_result, hedge = Chatbot.hedged_answer("question", "hedge-test", None, "failed")
+                with self.assertRaises(RuntimeError):
+                    "".join(hedge)
+            time.sleep(0.3)
+            stats = Chatbot.hedge_stats
+            self.assertEqual((stats["fast"]["hedges_started"], stats["fast"]["rag_won"], stats["fast"]["wasted_tokens"]), (0, 1, 0))
+            self.assertEqual((stats["slow"]["hedges_started"], stats["slow"]["rag_won"], stats["slow"]["hedge_won"]), (1, 1, 0))
+            self.assertGreater(stats["slow"]["wasted_tokens"], 0)
+            self.assertEqual((stats["fallback"]["hedges_started"], stats["fallback"]["hedge_won"]), (1, 1))
+            self.assertEqual((stats["failed"]["hedges_started"], stats["failed"]["hedge_won"]), (1, 0))
+
+    def test_conversation_window(self):
+        summarized = []
+
+        def summarize_turns(summary, turns, usage=None):
+            summarized.append(len(turns))
+            return f"{sum(summarized)} turns summarized"
+
+        executor = ThreadPoolExecutor(max_workers=2)
+        with mock.patch.multiple(Chatbot, conversations=Chatbot.ConversationStore(), chat_executor=executor, CONVERSATION_TOKEN_BUDGET=40,
+                                 CONVERSATION_SUMMARY=True, summarize_turns=summarize_turns, get_system_prompt=lambda: "System prompt"):
+            for i in range(6):
+                Chatbot.record_turn("window-test", f"question {i} " * 3, f"answer {i} " * 3)
+            executor.shutdown(wait=True)
+            conversation = Chatbot.conversations.load("window-test")
+            self.assertLessEqual(sum(turn["tokens"] for turn in conversation["turns"]), 40)
+            self.assertEqual(conversation["trimmed"], [])
+            self.assertEqual(sum(summarized) + len(conversation["turns"]), 12)
+            prompt = Chatbot.build_prompt("window-test", "next question")
+            self.assertEqual([message["role"] for message in prompt].count("system"), 1)
+            self.assertEqual(prompt[0]["role"], "system")
+            self.assertTrue(prompt[0]["content"].startswith("System prompt"))
+            self.assertIn(f"{sum(summarized)} turns summarized", prompt[0]["content"])
+            self.assertEqual(prompt[1:-1], [{"role": turn["role"], "content": turn["content"]} for turn in conversation["turns"]])
+            self.assertEqual(prompt[-1], {"role": "user", "content": "next question"})
+
+    def test_concurrent_turns(self):
+        with mock.patch.multiple(Chatbot, conversations=Chatbot.ConversationStore(), CONVERSATION_TOKEN_BUDGET=100000):
+            threads = [threading.Thread(target=Chatbot.record_turn, args=("concurrent-test", f"question {i}", f"answer {i}")) for i in range(20)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(len(Chatbot.conversations.load("concurrent-test")["turns"]), 40)
+
+    def test_semantic_cache(self):
+        rng = np.random.default_rng(0)
+        question, other = rng.standard_normal((2, 1536))
+        other -= other @ question / (question @ question) * question
+
+        def similar(cosine):
+            # Vector at the given cosine similarity from the question
+            return cosine * question / np.linalg.norm(question) + np.sqrt(1 - cosine ** 2) * other / np.linalg.norm(other)
+
+        cache = Chatbot.SemanticCache(max_entries=2, threshold=Chatbot.SEMANTIC_CACHE_THRESHOLD)
+        cache.add(question, 1, "answer")
+        self.assertEqual(cache.lookup(question * 3, 1), "answer")
+        self.assertEqual(cache.lookup(similar(0.99), 1), "answer")
+        # A different question on the same topic
+        self.assertIsNone(cache.lookup(similar(0.93), 1))
+        self.assertIsNone(cache.lookup(rng.standard_normal(1536), 1))
+        self.assertIsNone(cache.lookup(question, 2))
+        self.assertEqual((cache.stats["hits"], cache.stats["misses"]), (2, 3))
+        cache.add(other, 2, "other answer")
+        cache.add(similar(0.5), 2, "third answer")
+        cache.add(question, 2, "new answer")
+        self.assertEqual(cache.lookup(question, 2), "new answer")
+        self.assertIsNone(cache.lookup(other, 2))
+        self.assertEqual(cache.stats["evictions"], 2)
+
+    def test_query_cache(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            path = os.path.join(cache_dir, "cache.sqlite3")
+            cache = Chatbot.QueryCache(path, max_entries=2, ttl=60)
+            key = Chatbot.QueryCache.make_key("question", 1)
+            self.assertNotEqual(key, Chatbot.QueryCache.make_key("question", 2))
+            self.assertIsNone(cache.get(key))
+            cache.set(key, {"answer": 42})
+            self.assertEqual(cache.get(key), {"answer": 42})
+            cache.set("b", 1)
+            cache.set("c", 2)
+            self.assertEqual(cache.stats["evictions"], 1)
+            # Evicted from the in-process LRU, served by SQLite and by another worker
+            self.assertEqual(cache.get(key), {"answer": 42})
+            self.assertEqual(Chatbot.QueryCache(path).get("c"), 2)
+            self.assertEqual((cache.stats["hits"], cache.stats["misses"]), (2, 1))
+            expired = Chatbot.QueryCache(path, ttl=0)
+            self.assertIsNone(expired.get(key))
+            memory = Chatbot.QueryCache(None, max_entries=1)
+            memory.set("a", 1)
+            memory.set("b", 2)
+            self.assertEqual((memory.get("a"), memory.get("b")), (None, 2))
+
+    def test_metrics(self):
+        response = self.app.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertIn("index_version", data)
+        self.assertEqual(set(data["query_cache"]), {"hits", "misses", "evictions"})
+
+    def test_ready(self):
+        response = self.app.get('/ready')
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200 if data["ready"] else 503)
+        self.assertEqual(set(data), {"ready", "index_version", "pid"})
+
+    def test_usage_meter(self):
+        meter = UsageMeter(prompt_price=1.0, completion_price=2.0)
+        usage = meter.request("session-1")
+        meter.add(usage, 100, 50)
+        meter.add(meter.request("session-1"), 10, 0)
+        meter.add(None, 5, 5)
+        self.assertEqual(meter.report(usage)["total_tokens"], 150)
+        self.assertAlmostEqual(meter.report(usage)["cost"], 0.2)
+        session = meter.session("session-1")
+        self.assertEqual((session["calls"], session["prompt_tokens"], session["completion_tokens"]), (2, 110, 50))
+        self.assertEqual(meter.stats["calls"], 3)
+        self.assertEqual(meter.session("unknown")["total_tokens"], 0)
+
+    def test_merge_chunks(self):
+        lines = [f"line {i} of the document" for i in range(60)]
+        metadata = {"source": "report.pdf", "page": 1}
+        chunks = ["\n".join(lines[0:25]), "\n".join(lines[20:45]), "\n".join(lines[40:60])]
+        docs = [Document(page_content=chunks[2], metadata=metadata), Document(page_content=chunks[0], metadata=metadata),
+                Document(page_content=chunks[1], metadata=metadata), Document(page_content=chunks[0], metadata={"source": "other.pdf"})]
+        merged = merge_chunks(docs)
+        self.assertEqual(len(merged), 2)
+        self.assertEqual(merged[0].page_content, "\n".join(lines))
+        self.assertEqual(merged[1].metadata, {"source": "other.pdf"})
+
+    def test_bm25_index(self):
+        index = BM25Index()
+        index.add([Document(page_content=text) for text in [
+            "The pump failed with error code E-1042 during startup",
+            "Quarterly revenue grew by ten percent",
+            "The pump maintenance schedule is monthly",
+        ]])
+        results = index.search("What does error E-1042 mean?", 3)
+        self.assertEqual(len(results), 1)
+        self.assertIn("E-1042", results[0][0].page_content)
+        self.assertEqual(len(index.search("pump", 3)), 2)
+        self.assertEqual(index.search("unknown words", 3), [])
+        copy = index.copy()
+        copy.add([Document(page_content="The pump pressure is low")])
+        self.assertEqual((len(index), len(copy)), (3, 4))
+        self.assertEqual(len(index.search("pump", 3)), 2)
+        copy.remove([0])
+        self.assertEqual(copy.search("E-1042", 3), [])
+        self.assertEqual(len(index.search("E-1042", 3)), 1)
+
+    def test_lexical_fast_path(self):
+        index = BM25Index()
+        index.add([Document(page_content=text) for text in [
+            "The pump failed with error code E-1042 during startup",
+            "Quarterly revenue grew by ten percent",
+            "The pump maintenance schedule is monthly",
+        ]])
+        snapshot = Chatbot.IndexSnapshot(None, index, None, None, 1)
+        with mock.patch.multiple(Chatbot, HYBRID_SEARCH=True, LEXICAL_FAST_PATH=True, LEXICAL_FAST_PATH_SCORE=0.8, LEXICAL_FAST_PATH_RATIO=2.0):
+            docs = Chatbot.lexical_fast_path("What does error E-1042 mean?", snapshot)
+            self.assertIn("E-1042", docs[0].page_content)
+            # Two matches of the same strength, or a weak partial match
+            self.assertIsNone(Chatbot.lexical_fast_path("pump", snapshot))
+            self.assertIsNone(Chatbot.lexical_fast_path("revenue of the pump maintenance team", snapshot))
+            # The normalized score does not grow with the corpus
+            index.add([Document(page_content=f"The cafeteria menu of week {i} lists soup and salad") for i in range(200)])
+            self.assertIsNotNone(Chatbot.lexical_fast_path("What does error E-1042 mean?", snapshot))
+            self.assertIsNone(Chatbot.lexical_fast_path("revenue of the pump maintenance team", snapshot))
+
+    def test_two_writers_from_empty_index(self):
+        with tempfile.TemporaryDirectory() as index_dir, tempfile.TemporaryDirectory() as document_dir, \
+                mock.patch.multiple(Chatbot, INDEX_STORE_DIRECTORY=index_dir, DOCUMENT_STORE_DIRECTORY=document_dir, embeddings=HashEmbeddings(),
+                                    read_from_web=lambda url: [Document(page_content=f"Content of {url}", metadata={"source": url})]):
+            empty_manifest = Chatbot.build_manifest([])
+            empty_index = Chatbot.IndexSnapshot(None, BM25Index(), None, None, Chatbot.index_fingerprint(empty_manifest))
+            urls = ["https://example.com/w1", "https://example.com/w2"]
+            # Two workers forked from a master with an empty corpus, each adds one page
+            for url in urls:
+                with mock.patch.multiple(Chatbot, live_index=empty_index, manifest=empty_manifest):
+                    self.assertEqual(Chatbot.add_webpage(url), 1)
+            self.assertEqual(Chatbot.read_manifest()["submitted_urls"], urls)
+            self.assertEqual(Chatbot.load_index(Chatbot.embeddings).index.ntotal, 2)
+
+    def test_ready_after_failed_build(self):
+        with tempfile.TemporaryDirectory() as index_dir, tempfile.TemporaryDirectory() as document_dir, \
+                mock.patch.multiple(Chatbot, INDEX_STORE_DIRECTORY=index_dir, DOCUMENT_STORE_DIRECTORY=document_dir, embeddings=FailingEmbeddings(),
+                                    live_index=Chatbot.live_index, manifest=Chatbot.manifest, get_webpages_urls=lambda: ["https://example.com/w1"],
+                                    read_from_webpages_url=lambda: [Document(page_content="Content of w1", metadata={"source": "https://example.com/w1"})]):
+            Chatbot.retry_index_build()
+            self.assertFalse(Chatbot.index_ready())
+            self.assertEqual(self.app.get('/ready').status_code, 503)
+            with mock.patch.object(Chatbot, 'embeddings', HashEmbeddings()):
+                Chatbot.retry_index_build()
+            self.assertTrue(Chatbot.index_ready())
+            self.assertEqual(self.app.get('/ready').status_code, 200)
+
+    def test_mapped_index_updates(self):
+        with tempfile.TemporaryDirectory() as index_dir, tempfile.TemporaryDirectory() as document_dir, \
+                mock.patch.multiple(Chatbot, INDEX_STORE_DIRECTORY=index_dir, DOCUMENT_STORE_DIRECTORY=document_dir, embeddings=HashEmbeddings(),
+                                    INDEX_TYPE='flat', COMPACT_VECTORS=False, live_index=Chatbot.live_index, manifest=Chatbot.manifest,
+                                    read_from_webpages_url=lambda: [Document(page_content="Content of w0", metadata={"source": "https://example.com/w0"})],
+                                    read_from_web=lambda url: [Document(page_content=f"Content of {url}", metadata={"source": url})]):
+            Chatbot.load_startup_index()
+            # The index is read back memory-mapped, the updates are added to a private copy and mapped once saved
+            for url in ["https://example.com/w1", "https://example.com/w2"]:
+                self.assertFalse(faiss.downcast_index(Chatbot.live_index.docsearch.index).codes.is_owned)
+                self.assertEqual(Chatbot.add_webpage(url), 1)
+            index = Chatbot.live_index.docsearch.index
+            self.assertFalse(faiss.downcast_index(index).codes.is_owned)
+            self.assertEqual(index.ntotal, 3)
+            self.assertEqual(Chatbot.dense_search(Chatbot.live_index, Chatbot.embeddings.embed_query("Content of https://example.com/w2"), 1)[0].page_content,
+                             "Content of https://example.com/w2")
+
+    def test_sync_pdf_files(self):
+        def load_pdf(filepath):
+            with open(filepath) as f:
+                return [Document(page_content=line, metadata={"source": filepath, "page": page}) for page, line in enumerate(f.read().splitlines())], None
+
+        def write(filename, lines):
+            with open(os.path.join(document_dir, filename), 'w') as f:
+                f.write("\n".join(lines))
+
+        def found(query):
+            dense = [doc.page_content for doc in Chatbot.dense_search(Chatbot.live_index, Chatbot.embeddings.embed_query(query), 10)]
+            return dense + [doc.page_content for doc, score in Chatbot.live_index.bm25_index.search(query, 10)]
+
+        with tempfile.TemporaryDirectory() as index_dir, tempfile.TemporaryDirectory() as document_dir, \
+                mock.patch.multiple(Chatbot, INDEX_STORE_DIRECTORY=index_dir, DOCUMENT_STORE_DIRECTORY=document_dir, embeddings=HashEmbeddings(),
+                                    load_pdf=load_pdf, PDF_WORKERS=1, read_from_webpages_url=lambda: [], COMPACT_REMOVED_RATIO=0.5):
+            write("a.pdf", ["alpha one", "alpha two"])
+            write("b.pdf", ["beta one", "beta two", "beta three"])
+            docsearch, manifest = Chatbot.build_or_load_index(Chatbot.embeddings)
+            with mock.patch.multiple(Chatbot, live_index=None, manifest=None):
+                Chatbot.publish_index(docsearch, Chatbot.build_bm25_index(docsearch), manifest)
+                self.assertEqual({filename: entry["chunks"] for filename, entry in Chatbot.manifest["pdfs"].items()}, {"a.pdf": [0, 2], "b.pdf": [2, 5]})
+                self.assertEqual(Chatbot.sync_pdf_files(), 0)
+                # A changed and an added file: only their chunks are added, the old chunks of a.pdf are excluded
+                write("a.pdf", ["alpha changed"])
+                write("c.pdf", ["gamma one"])
+                self.assertEqual(Chatbot.sync_pdf_files(), 2)
+                self.assertEqual(Chatbot.manifest["removed_chunks"], [[0, 2]])
+                self.assertEqual(Chatbot.live_index.docsearch.index.ntotal, 7)
+                self.assertNotIn("alpha one", found("alpha one"))
+                self.assertIn("alpha changed", found("alpha changed"))
+                self.assertIn("gamma one", found("gamma one"))
+                # A removed file: 5 of the 7 chunks are now excluded, above COMPACT_REMOVED_RATIO, the index is compacted
+                os.remove(os.path.join(document_dir, "b.pdf"))
+                self.assertEqual(Chatbot.sync_pdf_files(), 1)
+                self.assertEqual(Chatbot.manifest["removed_chunks"], [])
+                self.assertEqual(Chatbot.live_index.docsearch.index.ntotal, 2)
+                self.assertFalse([text for text in found("beta one") if text.startswith("beta")])
+            # A restart loads the synced index without re-reading the files
+            with mock.patch.object(Chatbot, 'load_pdf', side_effect=AssertionError("PDF read again")):
+                docsearch, manifest = Chatbot.build_or_load_index(Chatbot.embeddings)
+            self.assertEqual(docsearch.index.ntotal, 2)
+
+    def test_startup_sync_failure(self):
+        def load_pdf(filepath):
+            with open(filepath) as f:
+                return [Document(page_content=f.read(), metadata={"source": filepath, "page": 0})], None
+
+        def write(filename, text):
+            with open(os.path.join(document_dir, filename), 'w') as f:
+                f.write(text)
+
+        with tempfile.TemporaryDirectory() as index_dir, tempfile.TemporaryDirectory() as document_dir, \
+                mock.patch.multiple(Chatbot, INDEX_STORE_DIRECTORY=index_dir, DOCUMENT_STORE_DIRECTORY=document_dir, embeddings=HashEmbeddings(),
+                                    load_pdf=load_pdf, PDF_WORKERS=1, read_from_webpages_url=lambda: [], live_index=Chatbot.live_index, manifest=Chatbot.manifest):
+            write("a.pdf", "alpha")
+            Chatbot.load_startup_index()
+            # A file added while the app was down, and the embeddings API is unreachable at restart
+            write("b.pdf", "beta")
+            with mock.patch.object(Chatbot, 'embeddings', FailingEmbeddings()):
+                Chatbot.load_startup_index()
+            self.assertTrue(Chatbot.index_ready())
+            self.assertEqual(Chatbot.live_index.docsearch.index.ntotal, 1)
+            # The watcher retries the sync once the API is back
+            self.assertEqual(Chatbot.sync_pdf_files(), 1)
+            self.assertEqual(Chatbot.live_index.docsearch.index.ntotal, 2)
+
+    def test_ingestion_queue(self):
+        with tempfile.TemporaryDirectory() as directory:
+            jobs = IngestionQueue(os.path.join(directory, 'jobs.sqlite3'), lambda url: 3 if url.endswith('/ok') else 1 / 0)
+            done, failed = jobs.submit('https://example.com/ok'), jobs.submit('https://example.com/fail')
+            deadline = time.time() + 5
+            while jobs.status(failed)["status"] in ("queued", "running") and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertEqual((jobs.status(done)["status"], jobs.status(done)["chunks"]), ("done", 3))
+            self.assertEqual(jobs.status(failed)["status"], "failed")
+            self.assertIn("division by zero", jobs.status(failed)["error"])
+            self.assertIsNone(jobs.status('unknown'))
+
+    def test_embedding_cache_models(self):
+        class SizedEmbeddings(HashEmbeddings):
+            def __init__(self, dimension):
+                self.dimension = dimension
+
+            def embed_query(self, text):
+                return (np.frombuffer(hashlib.sha256(text.encode('utf-8')).digest(), dtype=np.uint8)[:self.dimension] / 255).tolist()
+
+        texts = ["alpha", "beta"]
+        with tempfile.TemporaryDirectory() as directory:
+            small = Chatbot.CachedEmbeddings(SizedEmbeddings(4), "model-small", directory)
+            np.testing.assert_allclose(small.embed_documents(texts), SizedEmbeddings(4).embed_documents(texts), rtol=1e-6)
+            large = Chatbot.CachedEmbeddings(SizedEmbeddings(8), "model-large", directory)
+            np.testing.assert_allclose(large.embed_documents(texts), SizedEmbeddings(8).embed_documents(texts), rtol=1e-6)
+            np.testing.assert_allclose(Chatbot.CachedEmbeddings(None, "model-small", directory).embed_documents(texts),
+                                       SizedEmbeddings(4).embed_documents(texts), rtol=1e-6)
+            with self.assertRaises(ValueError):
+                Chatbot.CachedEmbeddings(SizedEmbeddings(6), "model-small", directory).embed_documents(["gamma"])
+            # A cache written before the per-model subdirectories is moved into the one of its model
+            for name in ('vectors.f32', 'keys.tsv', 'meta.json'):
+                os.replace(os.path.join(small.directory, name), os.path.join(directory, name))
+            legacy = Chatbot.CachedEmbeddings(None, "model-small", directory)
+            self.assertEqual(len(legacy.embed_documents(texts)[0]), 4)
+            self.assertEqual(legacy.hits, 2)
+
+    def test_chunk_store(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = ChunkStore(directory)
+            store.append([Document(page_content=f"chunk {i}", metadata={"source": "report.pdf", "page": i}) for i in range(3)])
+            self.assertEqual(len(store), 3)
+            self.assertEqual(store.search("1").page_content, "chunk 1")
+            self.assertEqual(store.document(2).metadata, {"source": "report.pdf", "page": 2})
+            self.assertEqual(store.search("3"), "ID 3 not found.")
+            # A second process maps the same files, dropping chunks appended after the saved index
+            reopened = ChunkStore(directory, count=2)
+            self.assertEqual([doc.page_content for doc in reopened.documents()], ["chunk 0", "chunk 1"])
+            with self.assertRaises(ValueError):
+                ChunkStore(directory, count=5)
+
+    def test_build_ann_index(self):
+        vectors = np.random.default_rng(0).standard_normal((2000, 32)).astype(np.float32)
+        exact = build_ann_index(vectors, 'flat').search(vectors[:50], 5)[1]
+        hnsw = build_ann_index(vectors, 'hnsw')
+        self.assertIsInstance(hnsw, faiss.IndexHNSW)
+        found = hnsw.search(vectors[:50], 5)[1]
+        recall = np.mean([len(set(a) & set(b)) / 5 for a, b in zip(found, exact)])
+        self.assertGreater(recall, 0.9)
+        self.assertIsInstance(build_ann_index(vectors, 'ivf'), faiss.IndexIVF)
+        # Too few vectors to train the IVF lists
+        self.assertNotIsInstance(build_ann_index(vectors[:10], 'ivf'), faiss.IndexIVF)
+
+    def test_search_parameters(self):
+        vectors = np.random.default_rng(0).random((200, 16), dtype=np.float32)
+        removed = np.arange(0, 100, dtype=np.int64)
+        self.assertIsNone(search_parameters(faiss.IndexFlatL2(16), removed[:0]))
+        for index_type in ('flat', 'ivf', 'hnsw'):
+            index = build_ann_index(vectors, index_type)
+            ids = index.search(vectors[:5], 10, params=search_parameters(index, removed))[1]
+            self.assertTrue((ids[ids != -1] >= 100).all(), index_type)
+
+    def test_rescore_compact_index(self):
+        vectors = np.random.default_rng(0).standard_normal((2000, 32)).astype(np.float32)
+        index = build_ann_index(vectors, 'flat', 'sq8', 16)
+        self.assertIsInstance(index, faiss.IndexPreTransform)
+        query = vectors[7]
+        candidates = index.search(query[None, :], 40)[1][0]
+        exact = faiss.knn(query[None, :], vectors, 5)[1][0]
+        rescored = rescore(vectors, query, candidates, 5)
+        self.assertEqual(rescored[0], 7)
+        self.assertEqual(rescored, sorted(rescored, key=lambda i: ((vectors[i] - query) ** 2).sum()))
+        self.assertGreaterEqual(len(set(rescored) & set(exact)), len(set(candidates[:5]) & set(exact)))
+
+    def test_fetch_webpages_concurrently(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), SlowPageHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            base_url = f"http://127.0.0.1:{server.server_port}"
+            urls = [f"{base_url}/page{i}" for i in range(4)] + [f"{base_url}/missing"]
+            start = time.time()
+            pages = fetch_webpages(urls)
+            elapsed = time.time() - start
+        finally:
+            server.shutdown()
+        # The missing page is skipped, the others are fetched in parallel and returned in order
+        self.assertEqual([page.metadata["source"] for page in pages], urls[:4])
+        self.assertEqual(pages[0].metadata["title"], "Test page")
+        self.assertLess(elapsed, len(urls) * SlowPageHandler.delay)
+
+    def test_fetch_webpage_encoding(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), SlowPageHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            page = Chatbot.fetch_webpage(f"http://127.0.0.1:{server.server_port}/utf8")
+        finally:
+            server.shutdown()
+        self.assertEqual(page.metadata["title"], "Café")
+        self.assertIn("Müller straße – 東京", page.page_content)
+
+    def test_embedding_executor_against_stub(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), StubEmbeddingHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            executor = EmbeddingExecutor(f"http://127.0.0.1:{server.server_port}/v1", "test-key", "stub-model",
+                                         max_batch_size=8, max_batch_tokens=40, max_concurrency=2, backoff=0.01,
+                                         token_counter=len)
+            texts = [f"chunk number {i}" for i in range(30)]
+            vectors = executor.embed_documents(texts)
+        finally:
+            server.shutdown()
+        self.assertEqual([vector[0] for vector in vectors], [float(len(text)) for text in texts])
+        self.assertEqual(executor.stats["rate_limited"], 1)
+        self.assertEqual(executor.stats["chunks"], len(texts))
+        self.assertGreater(executor.stats["chunks_per_second"], 0)
+
+    def test_query_embedding_during_ingestion(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), SlowEmbeddingHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            executor = EmbeddingExecutor(f"http://127.0.0.1:{server.server_port}/v1", "test-key", "stub-model",
+                                         max_batch_size=1, max_concurrency=1, token_counter=len)
+            ingestion = threading.Thread(target=executor.embed_documents, args=([f"chunk number {i}" for i in range(6)],))
+            ingestion.start()
+            time.sleep(SlowEmbeddingHandler.delay / 2)
+            started = time.time()
+            vector = executor.embed_query("query")
+            elapsed = time.time() - started
+            ingestion.join()
+        finally:
+            server.shutdown()
+        self.assertEqual(vector, [5.0, 1.0])
+        # One request, without waiting for the ingestion batches holding the only slot
+        self.assertLess(elapsed, 1.5 * SlowEmbeddingHandler.delay)
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,8 +1,8 @@
 import os
 import sys
 import time
-import pickle
 import logging
+from functools import lru_cache
 from flask import Flask, request, render_template, jsonify
 from langchain.chains.question_answering import load_qa_chain
 from langchain.document_loaders import PyPDFLoader, WebBaseLoader
@@ -48,6 +48,8 @@ if not OPENAI_MODEL_NAME:
     raise ValueError("OPENAI_MODEL_NAME environment variable not set")
 
 OPENAI_TEMPERATURE = 0
+SEARCH_RESULTS_K = int(os.getenv('SEARCH_RESULTS_K', 4))
+WEBPAGE_CACHE_SIZE = int(os.getenv('WEBPAGE_CACHE_SIZE', 32))
 
 
 # functions
@@ -91,54 +93,43 @@ def split_text(raw_text):
     texts = text_splitter.split_documents(raw_text)
     return texts
 
-def create_embeddings(texts):
+def create_embeddings():
     """
-    Create OpenAI embeddings for the text chunks
+    Create the OpenAI embeddings client for the text chunks
     """
-    if not INDEX_STORE_DIRECTORY:
-        raise ValueError("INDEX_STORE_DIRECTORY environment variable not set check the file .env")
-    if not os.path.isdir(INDEX_STORE_DIRECTORY):
-        raise ValueError(f"{INDEX_STORE_DIRECTORY} is not a directory")
-    embeddings = OpenAIEmbeddings()
-    index_path = os.path.join(INDEX_STORE_DIRECTORY, 'Index.pkl')
-    with open(index_path, 'wb') as f:
-        pickle.dump(embeddings, f)
-    return embeddings
-
-def read_embeddings():
-    """
-    Read the embeddings from file
-    """
-    index_path = os.path.join(INDEX_STORE_DIRECTORY, 'Index.pkl')
-    with open(index_path, 'rb') as f:
-        embeddings = pickle.load(f)
-    return embeddings
+    return OpenAIEmbeddings()
 
 def create_index(texts, embeddings):
     """
     Create a FAISS index for the text chunks
     """
+    if not texts:
+        logger.warning("No texts found. Skipping index creation.")
+        return None
     docsearch = FAISS.from_documents(texts, embeddings)
     return docsearch
 
-def search_documents(query, docsearch):
-    """
-    Search the documents for the given query
-    """
-    cache_path = os.path.join(INDEX_STORE_DIRECTORY, 'openai_cache.pkl')
-    if os.path.exists(cache_path):
-        with open(cache_path, 'rb') as f:
-            cache = pickle.load(f)
-    else:
-        cache = {}
-    if query in cache:
-        docs = cache[query]
-    else:
-        docs = docsearch.similarity_search(query)
-        cache[query] = docs
-        with open(cache_path, 'wb') as f:
-            pickle.dump(cache, f)
-    return docs
+@lru_cache(maxsize=WEBPAGE_CACHE_SIZE)
+def read_webpage_index(webpage):
+    """
+    Fetch, split and embed a web page once, later requests for the same URL reuse its index
+    """
+    return create_index(split_text(read_from_web(webpage)), embeddings)
+
+def search_documents(query, docsearch, web_docsearch=None):
+    """
+    Search the base index and the optional web page index for the given query and merge the results by distance.
+    The query is embedded once and the same vector is used for both indexes.
+    """
+    indexes = [index for index in (docsearch, web_docsearch) if index is not None]
+    if not indexes:
+        return []
+    query_embedding = embeddings.embed_query(query)
+    results = []
+    for index in indexes:
+        results.extend(index.similarity_search_with_score_by_vector(query_embedding, k=SEARCH_RESULTS_K))
+    results.sort(key=lambda result: result[1])
+    return [doc for doc, score in results[:SEARCH_RESULTS_K]]
 
 def answer_question(docs, query):
     """
@@ -148,6 +139,10 @@ def answer_question(docs, query):
     result = chain.run(input_documents=docs, question=query)
     return result
 
+# Build the PDF index once at startup, requests only embed the optional web page
+embeddings = create_embeddings()
+docsearch = create_index(split_text(read_from_PDF()), embeddings)
+
 app = Flask(__name__)
 
 @app.route('/')
@@ -156,15 +151,9 @@ def index():
 
 @app.route('/answer', methods=['POST'])
 def answer():
-    raw_text = read_from_PDF()
     webpage = request.form.get('webpage')
-    web_text = read_from_web(webpage)
-    raw_text.extend(web_text)
-    texts = split_text(raw_text)
-    embeddings = create_embeddings(texts)
-    embeddings = read_embeddings()
-    docsearch = create_index(texts, embeddings)
+    web_docsearch = read_webpage_index(webpage.strip()) if webpage else None
     query = request.form.get('query')
-    docs = search_documents(query, docsearch)
+    docs = search_documents(query, docsearch, web_docsearch)
     result = answer_question(docs, query)
     return render_template('answer.html', result=result)